@@ -29,11 +29,16 @@ setup(
 
     python_requires='>=3.6',
     install_requires=['python-crontab>=2.2'],
+    extras_require={
+        'async': ['aiohttp>=3.0'],
+        'lxml': ['lxml>=4.0'],
+    },
 
     packages=find_packages(),
     entry_points={
         'console_scripts': [
             'wpcraft = wpcraft.wpcraft:main',
+            'wpcraft-bench = wpcraft.bench.bench:main',
         ],
     },
 )
@@ -0,0 +1,3 @@
+from .backends import Backend, BACKENDS, detect_backend, get_backend
+
+__all__ = ["Backend", "BACKENDS", "detect_backend", "get_backend"]
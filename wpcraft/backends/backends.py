@@ -0,0 +1,229 @@
+import os
+import shutil
+import subprocess
+from typing import Dict, List, Optional, Tuple, Type
+
+from wpcraft.types import Monitor
+from wpcraft.utils.utils import write_json_atomically
+
+# Wallpaper backends set the desktop background to a downloaded image. The
+# one to use is chosen with the "backend" config setting, or detected from
+# the desktop environment when it is "auto".
+
+# With several monitors, backends which can set a different wallpaper on each
+# one are also given an image for every monitor, in its own resolution.
+PerMonitor = Optional[List[Tuple[Monitor, str]]]
+
+
+class Backend:
+    """Sets the wallpaper on a particular kind of desktop.
+
+    Backends are created once per process and may keep state (e.g. a
+    GSettings handle) between switches.
+    """
+    name = ""
+
+    def set_wallpaper(self, path: str, per_monitor: PerMonitor=None) -> None:
+        raise NotImplementedError
+
+    @classmethod
+    def available(cls) -> bool:
+        return True
+
+
+def run(argv: List[str]) -> bool:
+    # Runs a command directly, without a shell, so that paths with spaces or
+    # quotes in them are passed as they are.
+    try:
+        result = subprocess.run(argv)
+    except FileNotFoundError:
+        print("Unable to set the wallpaper: {} is not installed.".format(
+            argv[0]))
+        return False
+    if result.returncode != 0:
+        print("Unable to set the wallpaper: {} exited with status {}.".format(
+            argv[0], result.returncode))
+        return False
+    return True
+
+
+class GSettingsBackend(Backend):
+    """Desktops which keep their background in GSettings.
+
+    The setting is changed in-process with Gio when PyGObject is installed,
+    and with the gsettings command otherwise.
+    """
+    schema = ""
+    # Keys set to the new wallpaper; those missing from the schema (e.g.
+    # picture-uri-dark before GNOME 42) are skipped.
+    keys: List[str] = []
+    uri = True
+
+    def __init__(self) -> None:
+        self.settings = None
+        try:
+            from gi.repository import Gio
+        except (ImportError, ValueError):
+            return
+        source = Gio.SettingsSchemaSource.get_default()
+        schema = source and source.lookup(self.schema, True)
+        if schema:
+            self.Gio = Gio
+            self.settings = Gio.Settings.new(self.schema)
+            self.keys = [k for k in self.keys if schema.has_key(k)]
+
+    def cli_keys(self) -> List[str]:
+        # Without Gio, the keys the schema has are listed with gsettings.
+        try:
+            listed = subprocess.run(
+                ["gsettings", "list-keys", self.schema],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL).stdout.decode('utf-8').split()
+        except FileNotFoundError:
+            listed = []
+        # Let `gsettings set` report what is wrong if nothing was listed.
+        return [k for k in self.keys if k in listed] or self.keys[:1]
+
+    def value(self, path: str) -> str:
+        if self.uri:
+            return "file://" + path
+        return path
+
+    def set_wallpaper(self, path: str, per_monitor: PerMonitor=None) -> None:
+        value = self.value(path)
+        if self.settings is None:
+            for key in self.cli_keys():
+                run(["gsettings", "set", self.schema, key, value])
+            return
+        for key in self.keys:
+            self.settings.set_string(key, value)
+        # Changes are written to dconf asynchronously, and would be lost if
+        # the process exited first.
+        self.Gio.Settings.sync()
+
+
+class GnomeBackend(GSettingsBackend):
+    name = "gnome"
+    schema = "org.gnome.desktop.background"
+    keys = ["picture-uri", "picture-uri-dark"]
+
+
+class CinnamonBackend(GSettingsBackend):
+    name = "cinnamon"
+    schema = "org.cinnamon.desktop.background"
+    keys = ["picture-uri"]
+
+
+class MateBackend(GSettingsBackend):
+    name = "mate"
+    schema = "org.mate.background"
+    keys = ["picture-filename"]
+    uri = False
+
+
+class XfceBackend(Backend):
+    name = "xfce"
+
+    def set_wallpaper(self, path: str, per_monitor: PerMonitor=None) -> None:
+        # Xfce keeps a separate background for each monitor and workspace,
+        # under properties such as
+        # /backdrop/screen0/monitorHDMI-1/workspace0/last-image.
+        paths = {"/monitor{}/".format(m.name): p
+                 for m, p in per_monitor or []}
+        try:
+            properties = subprocess.run(
+                ["xfconf-query", "-c", "xfce4-desktop", "-l"],
+                stdout=subprocess.PIPE).stdout.decode('utf-8').split()
+        except FileNotFoundError:
+            print("Unable to set the wallpaper: xfconf-query is not "
+                  "installed.")
+            return
+        for prop in properties:
+            if prop.endswith("/last-image"):
+                value = next((p for m, p in paths.items() if m in prop), path)
+                run(["xfconf-query", "-c", "xfce4-desktop", "-p", prop,
+                     "-s", value])
+
+
+class FehBackend(Backend):
+    """For window managers without a desktop of their own."""
+    name = "feh"
+
+    def set_wallpaper(self, path: str, per_monitor: PerMonitor=None) -> None:
+        # feh sets one image per Xinerama screen, in the order given.
+        paths = [p for m, p in per_monitor] if per_monitor else [path]
+        run(["feh", "--no-fehbg", "--bg-fill"] + paths)
+
+    @classmethod
+    def available(cls) -> bool:
+        return (shutil.which("feh") is not None and
+                bool(os.getenv("DISPLAY")))
+
+
+class FileBackend(Backend):
+    """Records the wallpaper in a file instead of setting it, for headless
+    systems and testing. The file holds a JSON object with the path, and
+    the image for each monitor if there are several.
+    """
+    name = "file"
+
+    def __init__(self, target: str) -> None:
+        self.target = target
+
+    def set_wallpaper(self, path: str, per_monitor: PerMonitor=None) -> None:
+        write_json_atomically(self.target, {
+            "path": path,
+            "monitors": {m.name: p for m, p in per_monitor or []},
+        })
+
+
+class NoneBackend(Backend):
+    """Leaves the wallpaper alone; images are only downloaded."""
+    name = "none"
+
+    def set_wallpaper(self, path: str, per_monitor: PerMonitor=None) -> None:
+        pass
+
+
+BACKENDS: Dict[str, Type[Backend]] = {
+    b.name: b for b in [GnomeBackend, CinnamonBackend, MateBackend,
+                        XfceBackend, FehBackend, FileBackend, NoneBackend]
+}
+
+# XDG_CURRENT_DESKTOP values, lowercase, of desktops using each backend.
+DESKTOPS = {
+    "gnome": "gnome", "ubuntu": "gnome", "unity": "gnome",
+    "budgie": "gnome", "pantheon": "gnome",
+    "x-cinnamon": "cinnamon", "cinnamon": "cinnamon",
+    "mate": "mate",
+    "xfce": "xfce",
+}
+
+
+# Variables detect_backend reads. Processes started outside of the desktop
+# session, such as cron jobs, take them from a process of the session.
+DESKTOP_VARIABLES = ["XDG_CURRENT_DESKTOP", "DESKTOP_SESSION"]
+
+
+def detect_backend(environ=os.environ) -> str:
+    desktops = environ.get("XDG_CURRENT_DESKTOP", "").lower().split(':')
+    desktops += [environ.get("DESKTOP_SESSION", "").lower()]
+    for desktop in desktops:
+        if desktop in DESKTOPS:
+            return DESKTOPS[desktop]
+    if FehBackend.available():
+        return "feh"
+    # What wpcraft has always assumed.
+    return "gnome"
+
+
+def get_backend(name: str, file_path: Optional[str]=None) -> Backend:
+    # file_path is where the file backend records wallpapers.
+    if name == "auto":
+        name = detect_backend()
+    if name not in BACKENDS:
+        exit("Error: Unknown wallpaper backend '{}'. Available backends: "
+             "auto, {}.".format(name, ", ".join(BACKENDS)))
+    if name == "file":
+        return FileBackend(file_path)
+    return BACKENDS[name]()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import contextlib
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+from wpcraft.types import WPScope, WPID, Resolution
+from wpcraft.standin import standin
+from wpcraft.wpcraftaccess import parsing
+from wpcraft.wpcraftaccess import wpcraftaccess as wpa
+
+# Benchmarks of the hot paths of wpcraft: parsing, crawling, startup,
+# selection and switching. Everything runs against fixture HTML or the local
+# stand-in server, never against wallpaperscraft.com, so results are
+# comparable between runs and releases.
+
+RESOLUTION = Resolution(1920, 1080)
+SCOPE = WPScope("catalog/bench")
+
+# Rate limits are lifted by default, so that the benchmarks measure wpcraft
+# rather than the pacing of requests.
+UNLIMITED = {'rate': 1e6, 'burst': 1e6, 'min-rate': 1e6, 'max-rate': 1e6}
+
+
+class Result(NamedTuple):
+    name: str
+    iterations: int
+    mean: float
+    median: float
+    min: float
+    max: float
+    stdev: float
+
+
+def measure(name: str, func: Callable[[], Any], iterations: int,
+            setup: Optional[Callable[[], Any]]=None) -> Result:
+    # setup runs before each iteration and is not timed.
+    times = []
+    for i in range(iterations):
+        if setup:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            t = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - t)
+    return Result(name, iterations, statistics.mean(times),
+                  statistics.median(times), min(times), max(times),
+                  statistics.stdev(times) if len(times) > 1 else 0.0)
+
+
+class Bench:
+    def __init__(self, options: standin.Options, workdir: str,
+                 index_size: int, iterations: int,
+                 respect_rate_limits: bool=False) -> None:
+        self.options = options
+        self.workdir = workdir
+        self.index_size = index_size
+        self.iterations = iterations
+        self.respect_rate_limits = respect_rate_limits
+        self.site = standin.SyntheticSite(options)
+        self.server, self.base_url = standin.start_in_background(options)
+        wpa.set_base_url(self.base_url)
+        self.config_path = os.path.join(workdir, "config.json")
+
+    def fixture(self, response: standin.Response) -> bytes:
+        return response[2]
+
+    def listing_html(self) -> bytes:
+        return self.fixture(self.site.listing(
+            SCOPE, "1920x1080", 1, "/catalog/bench/1920x1080/page{}"))
+
+    def write_config(self, scope: str) -> None:
+        os.makedirs(self.workdir, exist_ok=True)
+        config: Dict[str, Any] = {
+            "state-path": os.path.join(self.workdir, "state.json"),
+            "preferences-path": os.path.join(self.workdir,
+                                             "preferences.json"),
+            "store-path": os.path.join(self.workdir, "wpcraft.db"),
+            "cache-dir": os.path.join(self.workdir, "cache"),
+            "scope": scope,
+            "resolution": "1920x1080",
+            "base-url": self.base_url,
+            "prefetch-count": 0,
+        }
+        if not self.respect_rate_limits:
+            config["rate-limits"] = {k: UNLIMITED for k in wpa.RATE_LIMITS}
+        json.dump(config, open(self.config_path, 'w'))
+
+    def write_large_profile(self) -> None:
+        # A long-time user: many likes, full history, a big cached index.
+        # Written in the legacy JSON format, and imported into the store
+        # before anything is measured.
+        wpids = [WPID("bench_wallpaper_{}".format(i))
+                 for i in range(self.index_size)]
+        json.dump({"liked": wpids[:self.index_size // 10],
+                   "disliked": wpids[-self.index_size // 20:],
+                   "votes": {t: 1 for t in standin.SYNTHETIC_TAGS}},
+                  open(os.path.join(self.workdir, "preferences.json"), 'w'))
+        json.dump({"current": wpids[0], "history": wpids[1:21],
+                   "last-changed": time.time()},
+                  open(os.path.join(self.workdir, "state.json"), 'w'))
+        os.makedirs(os.path.join(self.workdir, "cache", "by_scope",
+                                 "catalog"))
+        json.dump({"updated": time.time(), "resolution": "1920x1080",
+                   "scores": [[w, float(i % 10)]
+                              for i, w in enumerate(wpids)]},
+                  open(os.path.join(self.workdir, "cache", "by_scope",
+                                    "catalog", "large.json"), 'w'))
+        self.make_wpcraft()
+
+    def reset_cache(self) -> None:
+        self.make_wpcraft().store.clear_scopes(SCOPE)
+
+    def warm_cache(self) -> None:
+        # Makes sure the scope index is in place, whichever benchmarks ran
+        # before.
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.make_wpcraft().get_wpids(SCOPE)
+
+    def make_wpcraft(self):
+        from wpcraft.wpcraft import WPCraft
+        return WPCraft(self.config_path)
+
+    def run(self, selected: Optional[List[str]]=None) -> List[Result]:
+        n = self.iterations
+        listing = self.listing_html()
+        wallpaper = self.fixture(self.site.wallpaper("bench_wallpaper_1"))
+        benchmarks = [
+            ("parse_npages", lambda: parsing.parse_npages(listing), n * 10,
+             None),
+            ("parse_page_entries",
+             lambda: parsing.parse_page_entries(listing), n * 10, None),
+            ("parse_wpdata",
+             lambda: parsing.parse_wpdata(WPID("x"), wallpaper), n * 10,
+             None),
+            ("get_npages", lambda: wpa.get_npages(SCOPE, RESOLUTION), n,
+             None),
+            ("get_page_entries",
+             lambda: wpa.get_page_entries(SCOPE, RESOLUTION, 1), n, None),
+            ("get_wpid_scores",
+             lambda: wpa.get_wpid_scores(SCOPE, RESOLUTION), n, None),
+            ("startup", self.make_wpcraft, n, None),
+            ("get_wpids_large_index",
+             lambda: self.make_wpcraft().get_wpids(
+                 WPScope("catalog/large")), n, None),
+            ("cmd_next_cold",
+             lambda: self.make_wpcraft().cmd_next(
+                 argparse.Namespace(dry_run=True)), n, self.reset_cache),
+            ("cmd_next_warm",
+             lambda: self.make_wpcraft().cmd_next(
+                 argparse.Namespace(dry_run=True)), n, self.warm_cache),
+        ]
+        self.write_config(SCOPE)
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.write_large_profile()
+        results = []
+        for name, func, iterations, setup in benchmarks:
+            if selected and name not in selected:
+                continue
+            results.append(measure(name, func, iterations, setup))
+            print("{:<24} {:>10.3f} ms".format(
+                name, results[-1].median * 1000), file=sys.stderr)
+        self.server.shutdown()
+        return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="wpcraft-bench",
+        description="Benchmark wpcraft against a local stand-in server.")
+    parser.add_argument('benchmarks', nargs='*',
+                        help="Only run the named benchmarks.")
+    parser.add_argument('--iterations', '-i', type=int, default=5)
+    parser.add_argument('--pages', type=int, default=50,
+                        help="Pages per scope on the stand-in server.")
+    parser.add_argument('--per-page', type=int, default=15)
+    parser.add_argument('--index-size', type=int, default=50000,
+                        help="Wallpapers in the large cached index.")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Latency of the stand-in server, in seconds.")
+    parser.add_argument('--respect-rate-limits', action="store_true",
+                        help="Keep the default rate limits.")
+    parser.add_argument('--output', '-o', metavar='FILE',
+                        help="Write results as JSON to FILE ('-' for "
+                        "stdout).")
+    args = parser.parse_args()
+
+    if not args.respect_rate_limits:
+        wpa.configure_rate_limits({k: UNLIMITED for k in wpa.RATE_LIMITS})
+
+    options = standin.Options(latency=args.latency, pages=args.pages,
+                              per_page=args.per_page, image_size=64 * 1024)
+    workdir = tempfile.mkdtemp(prefix="wpcraft-bench-")
+    try:
+        bench = Bench(options, workdir, args.index_size, args.iterations,
+                      args.respect_rate_limits)
+        results = bench.run(args.benchmarks)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report: Dict[str, Any] = {
+        'python': platform.python_version(),
+        'parser': parsing.PARSER,
+        'options': options._asdict(),
+        'results': [r._asdict() for r in results],
+    }
+    if args.output == '-':
+        json.dump(report, sys.stdout, indent=4)
+    elif args.output:
+        json.dump(report, open(args.output, 'w'), indent=4)
+
+
+if __name__ == "__main__":
+    main()
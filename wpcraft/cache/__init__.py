@@ -0,0 +1,3 @@
+from .cache import WPDataCache, ImageUrlCache, PrefetchQueue, ImageCache
+
+__all__ = ["WPDataCache", "ImageUrlCache", "PrefetchQueue", "ImageCache"]
@@ -0,0 +1,326 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Any, Optional, List, Set, Tuple, Iterator
+
+from wpcraft.types import WPID, WPData, Resolution
+from wpcraft.utils.utils import file_lock, write_json_atomically
+from wpcraft.profiling import profiling
+
+
+@contextmanager
+def locked_json_file(path: str) -> Iterator[Dict[str, Any]]:
+    # Loads a JSON document which may be modified by several processes at
+    # once, and writes it back when done, if it was changed. Each such file
+    # is guarded by an accompanying lock file.
+    with file_lock(path):
+        try:
+            data = json.load(open(path, 'r'))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            data = {}
+        before = json.dumps(data)
+        yield data
+        if json.dumps(data) != before:
+            write_json_atomically(path, data)
+
+
+class WPDataCache:
+    """Persistent store of wallpaper metadata, keyed by WPID.
+
+    Entries older than 'ttl' seconds are treated as missing. When the store
+    grows beyond 'max_entries', the least recently used entries are evicted.
+    """
+    def __init__(self, path: str, ttl: float, max_entries: int) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self.dirty = False
+        # Metadata may be looked up from several threads at once.
+        self.lock = threading.RLock()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        # The file is only read once something actually asks for metadata, so
+        # that commands which never touch it do not pay for parsing it.
+        if self.entries is None:
+            try:
+                self.entries = json.load(open(self.path, 'r'))
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                self.entries = {}
+        return self.entries
+
+    def get(self, wpid: WPID) -> Optional[WPData]:
+        with self.lock:
+            return self._get(wpid)
+
+    def _get(self, wpid: WPID) -> Optional[WPData]:
+        entries = self.load()
+        entry = entries.get(wpid)
+        if entry is None:
+            profiling.count("wpdata-cache.miss")
+            return None
+        now = time.time()
+        if now - entry['fetched'] > self.ttl:
+            del entries[wpid]
+            self.dirty = True
+            profiling.count("wpdata-cache.expired")
+            return None
+        profiling.count("wpdata-cache.hit")
+        # Recording every single access would rewrite the file on each run;
+        # hourly granularity is plenty for LRU ordering.
+        if now - entry['used'] > 3600:
+            entry['used'] = now
+            self.dirty = True
+        return WPData(**entry['data'])
+
+    def put(self, wpdata: WPData) -> None:
+        with self.lock:
+            self._put(wpdata)
+
+    def _put(self, wpdata: WPData) -> None:
+        entries = self.load()
+        now = time.time()
+        entries[wpdata.id] = {
+            'fetched': now,
+            'used': now,
+            'data': wpdata._asdict(),
+        }
+        self.dirty = True
+        self.evict()
+
+    def evict(self) -> None:
+        entries = self.load()
+        excess = len(entries) - self.max_entries
+        if excess <= 0:
+            return
+        lru = sorted(entries, key=lambda k: entries[k]['used'])
+        for wpid in lru[:excess]:
+            del entries[wpid]
+        self.dirty = True
+
+    def save(self) -> None:
+        # The prefetching process saves its own additions, so entries are
+        # merged with those on disk, keeping the more recent of each.
+        with self.lock:
+            if not self.dirty or self.entries is None:
+                return
+            with locked_json_file(self.path) as data:
+                for wpid, entry in self.entries.items():
+                    stored = data.get(wpid)
+                    if (stored is None or
+                            (stored['fetched'], stored['used']) <
+                            (entry['fetched'], entry['used'])):
+                        data[wpid] = entry
+                self.entries = data
+                self.evict()
+            self.dirty = False
+
+
+class ImageUrlCache:
+    """Persistent mapping from a wallpaper and resolution to its image URL.
+
+    A missing URL (None) records that the wallpaper is not available in that
+    resolution; such entries expire after 'negative_ttl' seconds. The file
+    may be updated by the prefetching process as well, so changes are merged
+    into it under a lock when saving.
+    """
+    def __init__(self, path: str, negative_ttl: float,
+                 max_entries: int) -> None:
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.entries: Optional[Dict[str, List[Any]]] = None
+        self.changed: Dict[str, Optional[List[Any]]] = {}
+
+    @staticmethod
+    def key(wpid: WPID, resolution: Resolution) -> str:
+        return "{} {}x{}".format(wpid, resolution.w, resolution.h)
+
+    def load(self) -> Dict[str, List[Any]]:
+        if self.entries is None:
+            try:
+                self.entries = json.load(open(self.path, 'r'))
+            except (FileNotFoundError, json.decoder.JSONDecodeError):
+                self.entries = {}
+        return self.entries
+
+    def lookup(self, wpid: WPID,
+               resolution: Resolution) -> Tuple[bool, Optional[str]]:
+        # Returns whether the answer is known, and the URL if there is one.
+        entry = self.load().get(self.key(wpid, resolution))
+        if entry is None:
+            profiling.count("image-url-cache.miss")
+            return False, None
+        url, stored = entry
+        if url is None and time.time() - stored > self.negative_ttl:
+            profiling.count("image-url-cache.expired")
+            return False, None
+        profiling.count("image-url-cache.hit")
+        return True, url
+
+    def store(self, wpid: WPID, resolution: Resolution,
+              url: Optional[str]) -> None:
+        key = self.key(wpid, resolution)
+        self.load()[key] = self.changed[key] = [url, time.time()]
+
+    def forget(self, wpid: WPID, resolution: Resolution) -> None:
+        key = self.key(wpid, resolution)
+        self.load().pop(key, None)
+        self.changed[key] = None
+
+    def save(self) -> None:
+        if not self.changed:
+            return
+        with locked_json_file(self.path) as data:
+            for key, entry in self.changed.items():
+                if entry is None:
+                    data.pop(key, None)
+                else:
+                    data[key] = entry
+            excess = len(data) - self.max_entries
+            if excess > 0:
+                for key in sorted(data, key=lambda k: data[k][1])[:excess]:
+                    del data[key]
+            self.entries = dict(data)
+        self.changed = {}
+
+
+class PrefetchQueue:
+    """Wallpapers already downloaded in the background, ready to be switched
+    to.
+
+    Entries are only valid for the selection settings (scope, resolution,
+    min-score) they were picked for, summarized as 'key'. The queue file is
+    shared between the foreground command and the prefetching process, every
+    access to it is guarded by a file lock.
+    """
+    def __init__(self, path: str, key: str) -> None:
+        self.path = path
+        self.key = key
+
+    @contextmanager
+    def locked(self) -> Iterator[List[Dict[str, str]]]:
+        with locked_json_file(self.path) as data:
+            if data.get('key') != self.key:
+                data.clear()
+                data.update({'key': self.key, 'ready': []})
+            ready = [e for e in data['ready'] if os.path.exists(e['path'])]
+            yield ready
+            data['ready'] = ready
+
+    def entries(self) -> List[Dict[str, str]]:
+        with self.locked() as ready:
+            return list(ready)
+
+    def pop(self) -> Optional[Dict[str, str]]:
+        with self.locked() as ready:
+            return ready.pop(0) if ready else None
+
+    def push(self, entry: Dict[str, str]) -> None:
+        with self.locked() as ready:
+            if all(e['id'] != entry['id'] for e in ready):
+                ready.append(entry)
+
+
+class ImageCache:
+    """Index of wallpaper images downloaded into the cache directory.
+
+    Keeps track of the size, last access time and number of uses of each
+    file, so that the cache can be kept within its budget without stat-ing
+    the whole directory. Files are named after their wallpaper ID.
+    """
+    IMAGE_EXTENSIONS = ['jpg', 'jpeg', 'png', 'webp']
+
+    def __init__(self, directory: str, max_bytes: int, max_files: int,
+                 policy: str='lru') -> None:
+        self.directory = directory
+        self.path = os.path.join(directory, "images.json")
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.policy = policy
+
+    @contextmanager
+    def locked(self) -> Iterator[Dict[str, Dict[str, float]]]:
+        with locked_json_file(self.path) as data:
+            if 'files' not in data:
+                data['files'] = self.scan()
+            yield data['files']
+
+    def scan(self) -> Dict[str, Dict[str, float]]:
+        # Only needed once, to pick up files downloaded before the index
+        # existed.
+        files = {}
+        try:
+            entries = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return {}
+        for entry in entries:
+            ext = entry.name.rsplit('.', 1)[-1].lower()
+            if entry.is_file() and ext in self.IMAGE_EXTENSIONS:
+                st = entry.stat()
+                files[entry.name] = {'size': st.st_size,
+                                     'used': st.st_atime, 'hits': 1}
+        return files
+
+    @staticmethod
+    def wpid_of(filename: str) -> WPID:
+        # Images for secondary monitors are named "<wpid>@<resolution>".
+        return WPID(filename.rsplit('.', 1)[0].split('@')[0])
+
+    def add(self, path: str) -> None:
+        with self.locked() as files:
+            files[os.path.basename(path)] = {
+                'size': os.path.getsize(path), 'used': time.time(), 'hits': 0}
+
+    def touch(self, path: str) -> None:
+        name = os.path.basename(path)
+        with self.locked() as files:
+            if name not in files:
+                files[name] = {'size': os.path.getsize(path), 'hits': 0}
+            files[name]['used'] = time.time()
+            files[name]['hits'] += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self.locked() as files:
+            return {
+                'files': len(files),
+                'bytes': sum(f['size'] for f in files.values()),
+                'oldest': min((f['used'] for f in files.values()),
+                              default=0.0),
+            }
+
+    def over_budget(self, files: Dict[str, Dict[str, float]]) -> bool:
+        return (len(files) > self.max_files or
+                sum(f['size'] for f in files.values()) > self.max_bytes)
+
+    def prune(self, protected: Set[WPID]) -> Tuple[int, int]:
+        # Removes least recently (or least frequently) used images until the
+        # cache fits its budget. Images of protected wallpapers are never
+        # removed. Returns the number of removed files and freed bytes.
+        removed = freed = 0
+        with self.locked() as files:
+            if not self.over_budget(files):
+                return 0, 0
+            if self.policy == 'lfu':
+                key = lambda n: (files[n]['hits'], files[n]['used'])
+            else:
+                key = lambda n: files[n]['used']
+            candidates = sorted((n for n in files
+                                 if self.wpid_of(n) not in protected),
+                                key=key)
+            total = sum(f['size'] for f in files.values())
+            for name in candidates:
+                if (len(files) <= self.max_files and
+                        total <= self.max_bytes):
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= files[name]['size']
+                removed += 1
+                freed += int(files[name]['size'])
+                del files[name]
+        return removed, freed
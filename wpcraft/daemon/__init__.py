@@ -0,0 +1,3 @@
+from .daemon import Daemon, send_command, is_running, socket_path
+
+__all__ = ["Daemon", "send_command", "is_running", "socket_path"]
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import errno
+import select
+import signal
+import socket
+from typing import Callable, List, Optional, Tuple
+
+# Commands are sent to the daemon as a single line of JSON, {"argv": [...]},
+# and answered with {"status": ..., "output": ...}.
+
+# How long a client waits for the daemon to accept a connection. A daemon
+# which doesn't answer by then is considered gone.
+CONNECT_TIMEOUT = 1.0
+# How long a client waits for a command to complete. Switching may involve
+# downloading an image.
+COMMAND_TIMEOUT = 300.0
+
+Handler = Callable[[List[str]], Tuple[int, str]]
+
+
+def socket_path(fallback_dir: str, run_root: str="/run/user") -> str:
+    # The daemon and its clients must agree on the path whatever their
+    # environment; cron jobs, for one, have no XDG_RUNTIME_DIR. The user's
+    # runtime directory is looked up directly where it exists.
+    runtime_dir = os.path.join(run_root, str(os.getuid()))
+    if not os.path.isdir(runtime_dir):
+        runtime_dir = os.getenv("XDG_RUNTIME_DIR") or fallback_dir
+    return os.path.join(runtime_dir, "wpcraft.sock")
+
+
+def read_message(conn: socket.socket) -> Optional[dict]:
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    try:
+        return json.loads(data.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def send_message(conn: socket.socket, message: dict) -> None:
+    conn.sendall(json.dumps(message).encode('utf-8') + b"\n")
+
+
+def send_command(path: str, argv: List[str]) -> Optional[Tuple[int, str]]:
+    # Runs a command in the daemon listening at path. Returns the exit
+    # status and output of the command, or None if no daemon is running.
+    if not os.path.exists(path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(CONNECT_TIMEOUT)
+        try:
+            conn.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+            return None
+        conn.settimeout(COMMAND_TIMEOUT)
+        try:
+            send_message(conn, {'argv': argv})
+            response = read_message(conn)
+        except OSError:
+            # The daemon may have run the command anyway, so it is not
+            # safe to run it again here.
+            exit("Error: wpcraft daemon did not answer ({}). Use --no-daemon "
+                 "to run the command directly.".format(path))
+    finally:
+        conn.close()
+    if response is None:
+        return None
+    return response['status'], response['output']
+
+
+def is_running(path: str) -> bool:
+    if not os.path.exists(path):
+        return False
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.settimeout(CONNECT_TIMEOUT)
+        conn.connect(path)
+        return True
+    except (ConnectionRefusedError, FileNotFoundError, socket.timeout):
+        return False
+    finally:
+        conn.close()
+
+
+class Daemon:
+    """Serves commands over a Unix socket, and runs scheduled work in
+    between.
+
+    'handle' runs a command given its arguments and returns its exit
+    status and output. 'tick' is called whenever the daemon wakes up; it
+    does whatever work is due and returns the number of seconds until it
+    wants to be called again, or None to wait for the next command.
+    Commands are handled one at a time.
+    """
+    def __init__(self, path: str, handle: Handler,
+                 tick: Callable[[], Optional[float]]) -> None:
+        self.path = path
+        self.handle = handle
+        self.tick = tick
+        self.running = False
+        self.busy = False
+
+    def bind(self) -> socket.socket:
+        if is_running(self.path):
+            exit("Error: wpcraft daemon is already running ({}).".format(
+                self.path))
+        # Left behind by a daemon which didn't exit cleanly.
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        server.listen(8)
+        return server
+
+    def stop(self, *args) -> None:
+        # select() is restarted after a signal, so an idle daemon has to be
+        # interrupted. A busy one finishes what it is doing first.
+        self.running = False
+        if not self.busy:
+            raise SystemExit(0)
+
+    def serve_forever(self) -> None:
+        server = self.bind()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        self.running = True
+        wake_at = time.monotonic()
+        try:
+            while self.running:
+                if time.monotonic() >= wake_at:
+                    self.busy = True
+                    delay = self.tick()
+                    self.busy = False
+                    wake_at = (time.monotonic() + delay if delay is not None
+                               else float('inf'))
+                # Stopped while busy; the signal came too early to interrupt
+                # select().
+                if not self.running:
+                    break
+                timeout = max(0.0, wake_at - time.monotonic())
+                try:
+                    readable, _, _ = select.select(
+                        [server], [], [],
+                        None if timeout == float('inf') else timeout)
+                except InterruptedError:
+                    continue
+                except OSError as e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                if readable:
+                    self.busy = True
+                    self.serve_one(server)
+                    self.busy = False
+                    # A command may have changed the schedule.
+                    wake_at = time.monotonic()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def serve_one(self, server: socket.socket) -> None:
+        conn, _ = server.accept()
+        try:
+            conn.settimeout(CONNECT_TIMEOUT)
+            request = read_message(conn)
+            if request is None or not isinstance(request.get('argv'), list):
+                return
+            status, output = self.handle(request['argv'])
+            conn.settimeout(COMMAND_TIMEOUT)
+            send_message(conn, {'status': status, 'output': output})
+        except (OSError, socket.timeout):
+            # The client went away, nothing to do about it.
+            pass
+        finally:
+            conn.close()
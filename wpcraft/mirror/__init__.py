@@ -0,0 +1,3 @@
+from .mirror import Mirror, Progress
+
+__all__ = ["Mirror", "Progress"]
@@ -0,0 +1,216 @@
+import os
+import sys
+import time
+import queue
+import threading
+import collections
+from typing import Callable, Deque, List, Optional, Tuple
+
+from wpcraft.types import WPID
+
+# Mirroring downloads every wallpaper of a scope in two overlapping stages:
+# resolvers find the image URL of each wallpaper, and downloaders fetch the
+# images. The stages are connected by bounded queues, so that URLs are never
+# resolved far ahead of the downloads.
+
+# Seconds over which the throughput shown is averaged.
+THROUGHPUT_WINDOW = 10.0
+# Seconds between updates of the progress line.
+PROGRESS_INTERVAL = 0.5
+
+# Returns the URL and target path of a wallpaper, or None if it has no image
+# in the requested resolution.
+Resolver = Callable[[WPID], Optional[Tuple[str, str]]]
+# Downloads a URL to a path, calling the callback with the size of every
+# chunk received. Returns whether it succeeded.
+Downloader = Callable[[str, str, Callable[[int], None]], bool]
+
+
+def format_bytes(n: float) -> str:
+    for unit in ['B', 'kB', 'MB']:
+        if n < 1024:
+            return "{:.1f} {}".format(n, unit)
+        n /= 1024
+    return "{:.1f} GB".format(n)
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return "{}:{:02}:{:02}".format(seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+
+
+class Progress:
+    """Counters shared by the stages of a mirror, and the live progress line
+    built from them.
+    """
+    def __init__(self, total: int, max_bytes: Optional[int]) -> None:
+        self.lock = threading.Lock()
+        self.total = total
+        self.max_bytes = max_bytes
+        self.done = 0
+        self.present = 0
+        self.failed = 0
+        self.unavailable = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        # (time, bytes) samples for the throughput window.
+        self.samples: Deque[Tuple[float, int]] = collections.deque()
+
+    def add_bytes(self, n: int) -> None:
+        with self.lock:
+            self.bytes += n
+
+    def finish(self, outcome: str) -> None:
+        # outcome is one of 'done', 'present', 'failed' or 'unavailable'.
+        with self.lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def handled(self) -> int:
+        return self.done + self.present + self.failed + self.unavailable
+
+    def over_budget(self) -> bool:
+        return self.max_bytes is not None and self.bytes >= self.max_bytes
+
+    def throughput(self) -> float:
+        t = time.monotonic()
+        with self.lock:
+            self.samples.append((t, self.bytes))
+            while t - self.samples[0][0] > THROUGHPUT_WINDOW:
+                self.samples.popleft()
+            first_t, first_bytes = self.samples[0]
+            if t - first_t < PROGRESS_INTERVAL:
+                return self.bytes / max(t - self.started, 1e-3)
+            return (self.bytes - first_bytes) / (t - first_t)
+
+    def line(self) -> str:
+        rate = self.throughput()
+        handled = self.handled()
+        eta = None
+        if self.done and rate > 0:
+            # Remaining wallpapers at the average size of the downloaded
+            # ones, or what is left of the budget if that runs out first.
+            remaining = self.bytes / self.done * (self.total - handled)
+            if self.max_bytes is not None:
+                remaining = min(remaining, max(0, self.max_bytes - self.bytes))
+            eta = remaining / rate
+        return "Mirrored {}/{}, {}, {}/s, ETA {}".format(
+            handled, self.total, format_bytes(self.bytes),
+            format_bytes(rate),
+            format_duration(eta) if eta is not None else "-")
+
+
+class Mirror:
+    """Downloads the images of a list of wallpapers, resolving URLs and
+    downloading in parallel.
+
+    Wallpapers which are already present are skipped, and interrupted
+    downloads are resumed by the downloader, so an interrupted mirror picks
+    up where it stopped when run again. Once max_bytes have been downloaded
+    no new downloads are started.
+    """
+    def __init__(self, resolve: Resolver, download: Downloader,
+                 resolvers: int=4, downloaders: int=4,
+                 max_bytes: Optional[int]=None) -> None:
+        self.resolve = resolve
+        self.download = download
+        self.resolvers = resolvers
+        self.downloaders = downloaders
+        self.max_bytes = max_bytes
+        self.stopping = threading.Event()
+
+    def put(self, q: queue.Queue, item) -> None:
+        # Gives up once the mirror is stopping, as there may be nobody left
+        # to take items off a full queue.
+        while not self.stopping.is_set():
+            try:
+                q.put(item, timeout=PROGRESS_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def resolve_worker(self, wpids: "queue.Queue[Optional[WPID]]",
+                       downloads: "queue.Queue[Optional[Tuple[str, str]]]",
+                       progress: Progress) -> None:
+        while True:
+            wpid = wpids.get()
+            if wpid is None or self.stopping.is_set():
+                return
+            try:
+                target = self.resolve(wpid)
+            except Exception:
+                # One wallpaper failing must not take the worker down.
+                progress.finish('failed')
+                continue
+            if target is None:
+                progress.finish('unavailable')
+            elif os.path.exists(target[1]):
+                progress.finish('present')
+            else:
+                self.put(downloads, target)
+
+    def download_worker(self,
+                        downloads: "queue.Queue[Optional[Tuple[str, str]]]",
+                        progress: Progress) -> None:
+        # Waits with a timeout, as the end of the queue is never marked once
+        # the mirror is stopping.
+        while not self.stopping.is_set():
+            try:
+                target = downloads.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                continue
+            if target is None:
+                return
+            if progress.over_budget():
+                self.stopping.set()
+                return
+            url, path = target
+            try:
+                downloaded = self.download(url, path, progress.add_bytes)
+            except Exception:
+                downloaded = False
+            progress.finish('done' if downloaded else 'failed')
+
+    def run(self, wpids: List[WPID], out=sys.stdout) -> Progress:
+        progress = Progress(len(wpids), self.max_bytes)
+        pending: "queue.Queue[Optional[WPID]]" = queue.Queue()
+        for wpid in wpids:
+            pending.put(wpid)
+        for i in range(self.resolvers):
+            pending.put(None)
+        # Resolvers stay at most a couple of wallpapers per downloader ahead.
+        downloads: "queue.Queue[Optional[Tuple[str, str]]]" = queue.Queue(
+            maxsize=2 * self.downloaders)
+
+        resolvers = [threading.Thread(target=self.resolve_worker,
+                                      args=(pending, downloads, progress),
+                                      daemon=True)
+                     for i in range(self.resolvers)]
+        downloaders = [threading.Thread(target=self.download_worker,
+                                        args=(downloads, progress),
+                                        daemon=True)
+                       for i in range(self.downloaders)]
+        for thread in resolvers + downloaders:
+            thread.start()
+
+        def wait(threads: List[threading.Thread]) -> None:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(PROGRESS_INTERVAL)
+                    print("\r" + progress.line(), end='', file=out,
+                          flush=True)
+
+        try:
+            wait(resolvers)
+            for i in range(self.downloaders):
+                self.put(downloads, None)
+            wait(downloaders)
+        except KeyboardInterrupt:
+            # Threads blocked on the network are left behind; whatever they
+            # downloaded so far is resumed by the next run.
+            self.stopping.set()
+            print("\nInterrupted, run the same command again to resume.",
+                  file=out)
+            return progress
+        print("\r" + progress.line(), file=out)
+        return progress
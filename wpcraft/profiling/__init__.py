@@ -0,0 +1,3 @@
+from .profiling import Profiler, profiler, enable, phase, count
+
+__all__ = ["Profiler", "profiler", "enable", "phase", "count"]
@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List
+
+# Instrumentation of the hot paths of wpcraft: HTTP requests, rate limiter
+# waits, parsing, cache lookups and the phases of each command. Recording is
+# disabled unless a command is run with --profile, in which case every
+# recording function returns right away.
+
+
+class Profiler:
+    """Collects requests, phases and counters of a single wpcraft run.
+
+    Results can be summarized as a human-readable breakdown, or written as
+    a JSON file in the Chrome trace event format, which chrome://tracing
+    and Perfetto can open directly; the summary is included in the same
+    file for scripts collecting profiles.
+    """
+    def __init__(self) -> None:
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        # Complete trace events (Chrome trace format), timestamps in
+        # microseconds since the profiler was enabled.
+        self.events: List[Dict[str, Any]] = []
+        self.requests: List[Dict[str, Any]] = []
+        self.counters: Dict[str, int] = {}
+
+    def enable(self) -> None:
+        self.enabled = True
+        self.started = time.perf_counter()
+
+    def timestamp(self, t: float) -> float:
+        return (t - self.started) * 1e6
+
+    def add_event(self, name: str, category: str, start: float,
+                  duration: float, args: Dict[str, Any]) -> None:
+        event = {
+            'name': name, 'cat': category, 'ph': 'X',
+            'ts': self.timestamp(start), 'dur': duration * 1e6,
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    @contextmanager
+    def phase(self, name: str, **args) -> Iterator[None]:
+        if not self.enabled:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_event(name, 'phase', t, time.perf_counter() - t, args)
+
+    def count(self, name: str, n: int=1) -> None:
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record_request(self, method: str, url: str, bucket: str,
+                       status: int, nbytes: int, latency: float,
+                       wait: float) -> None:
+        # latency is the time to the response headers, wait the time spent
+        # sleeping in the rate limiter before the request was sent.
+        if not self.enabled:
+            return
+        end = time.perf_counter()
+        request = {
+            'method': method, 'url': url, 'bucket': bucket,
+            'status': status, 'bytes': nbytes, 'latency': latency,
+            'wait': wait,
+        }
+        with self.lock:
+            self.requests.append(request)
+        if wait > 0:
+            self.add_event('rate limit ({})'.format(bucket), 'wait',
+                           end - latency - wait, wait, {})
+        self.add_event('{} {}'.format(method, url), 'request',
+                       end - latency, latency, request)
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            events = list(self.events)
+            requests = list(self.requests)
+            counters = dict(self.counters)
+        phases: Dict[str, Dict[str, float]] = {}
+        for e in events:
+            if e['cat'] != 'phase':
+                continue
+            p = phases.setdefault(e['name'], {'count': 0, 'total': 0.0,
+                                              'max': 0.0})
+            p['count'] += 1
+            p['total'] += e['dur'] / 1e6
+            p['max'] = max(p['max'], e['dur'] / 1e6)
+        by_bucket: Dict[str, Dict[str, Any]] = {}
+        for r in requests:
+            b = by_bucket.setdefault(r['bucket'], {
+                'count': 0, 'bytes': 0, 'latency': 0.0, 'max-latency': 0.0,
+                'wait': 0.0, 'statuses': {}})
+            b['count'] += 1
+            b['bytes'] += r['bytes']
+            b['latency'] += r['latency']
+            b['max-latency'] = max(b['max-latency'], r['latency'])
+            b['wait'] += r['wait']
+            status = str(r['status'])
+            b['statuses'][status] = b['statuses'].get(status, 0) + 1
+        return {
+            'total': time.perf_counter() - self.started,
+            'phases': phases,
+            'requests': by_bucket,
+            'counters': counters,
+        }
+
+    def report(self, out=sys.stderr) -> None:
+        summary = self.summary()
+        print("Profile ({:.3f}s total):".format(summary['total']), file=out)
+        if summary['phases']:
+            print("  Phases:", file=out)
+        for name, p in sorted(summary['phases'].items(),
+                              key=lambda i: -i[1]['total']):
+            print("    {:<24} {:>5}x {:>10.1f} ms".format(
+                name, p['count'], p['total'] * 1000), file=out)
+        if summary['requests']:
+            print("  Requests:", file=out)
+        for bucket, b in sorted(summary['requests'].items()):
+            print("    {:<8} {:>5}x {:>10.1f} ms (max {:.1f} ms), "
+                  "waited {:.1f} ms, {} bytes, status {}".format(
+                      bucket, b['count'], b['latency'] * 1000,
+                      b['max-latency'] * 1000, b['wait'] * 1000,
+                      b['bytes'], ", ".join(
+                          "{}: {}".format(s, n)
+                          for s, n in sorted(b['statuses'].items()))),
+                  file=out)
+        if summary['counters']:
+            print("  Counters:", file=out)
+        for name, n in sorted(summary['counters'].items()):
+            print("    {:<24} {:>6}".format(name, n), file=out)
+
+    def write(self, path: str) -> None:
+        with self.lock:
+            events = list(self.events)
+        json.dump({
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'summary': self.summary(),
+            'requests': self.requests,
+        }, open(path, 'w'), indent=1)
+
+
+profiler = Profiler()
+
+
+def enable() -> None:
+    profiler.enable()
+
+
+def phase(name: str, **args):
+    return profiler.phase(name, **args)
+
+
+def count(name: str, n: int=1) -> None:
+    profiler.count(name, n)
+
+
+def record_request(method: str, url: str, bucket: str, status: int,
+                   nbytes: int, latency: float, wait: float) -> None:
+    profiler.record_request(method, url, bucket, status, nbytes, latency,
+                            wait)
@@ -0,0 +1,3 @@
+from .standin import Options, make_server, start_in_background
+
+__all__ = ["Options", "make_server", "start_in_background"]
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import socketserver
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from typing import Dict, NamedTuple, Optional, Tuple
+
+# A local stand-in for wallpaperscraft.com. It replays responses recorded
+# from the real site, or makes up a synthetic site with the same markup, so
+# that crawling, downloading and rate limiting can be measured and tested
+# without network access. Point wpcraft at it with the WPCRAFT_BASE_URL
+# environment variable or the 'base-url' config key.
+
+UPSTREAM_URL = "https://wallpaperscraft.com"
+
+SYNTHETIC_TAGS = ["city", "night", "nature", "sea", "mountains", "forest",
+                  "clouds", "sky", "bridge", "lights", "sunset", "road"]
+
+# Minimal JPEG header, so that synthetic images pass the magic bytes check.
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+
+
+class Options(NamedTuple):
+    # Seconds added to each response.
+    latency: float = 0.0
+    # Bytes per second at which response bodies are sent; 0 is unlimited.
+    bandwidth: float = 0.0
+    # Fractions of requests answered with 500 and with 429 respectively.
+    error_rate: float = 0.0
+    throttle_rate: float = 0.0
+    # Directory with recorded responses.
+    record_dir: Optional[str] = None
+    # If set, requests missing from the recordings are forwarded to this
+    # URL and the responses are recorded.
+    upstream: Optional[str] = None
+    # Shape of the synthetic site, used for requests which are neither
+    # recorded nor forwarded. 0 pages disables it.
+    pages: int = 20
+    per_page: int = 15
+    image_size: int = 256 * 1024
+    seed: int = 0
+
+
+Response = Tuple[int, Dict[str, str], bytes]
+
+
+class Recordings:
+    """Responses stored on disk, keyed by request method and path."""
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.lock = threading.Lock()
+        try:
+            self.index = json.load(
+                open(os.path.join(directory, "index.json"), 'r'))
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.index = {}
+
+    def get(self, key: str) -> Optional[Response]:
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        body = open(os.path.join(self.directory, entry['body']), 'rb').read()
+        return entry['status'], entry['headers'], body
+
+    def put(self, key: str, response: Response) -> None:
+        status, headers, body = response
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest() + ".bin"
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            open(os.path.join(self.directory, name), 'wb').write(body)
+            self.index[key] = {'status': status, 'headers': headers,
+                               'body': name}
+            json.dump(self.index,
+                      open(os.path.join(self.directory, "index.json"), 'w'),
+                      indent=4)
+
+
+class SyntheticSite:
+    """Made-up wallpapers, served with the markup wpcraft parses."""
+    def __init__(self, options: Options) -> None:
+        self.options = options
+
+    def rng(self, *key) -> random.Random:
+        return random.Random("{}/{}".format(self.options.seed, key))
+
+    def wpid(self, scope: str, n: int) -> str:
+        name = scope.replace('/', '_').replace(' ', '_')
+        return "{}_wallpaper_{}".format(name, 100000 + n)
+
+    def page(self, title: str, body: str) -> Response:
+        html = ("<!DOCTYPE html><html><head><title>{}</title></head>"
+                "<body>{}</body></html>").format(title, body)
+        return 200, {'Content-Type': 'text/html; charset=utf-8'}, \
+            html.encode('utf-8')
+
+    def listing(self, scope: str, resolution: str, page_n: int,
+                page_href: str) -> Response:
+        pages, per_page = self.options.pages, self.options.per_page
+        if page_n > pages:
+            return 404, {}, b"Not found"
+        rng = self.rng(scope, page_n)
+        items = []
+        for i in range((page_n - 1) * per_page, page_n * per_page):
+            wpid = self.wpid(scope, i)
+            items.append(
+                '<li class="wallpapers__item">'
+                '<a class="wallpapers__link" href="/wallpaper/{0}/{1}">'
+                '<img class="wallpapers__image" '
+                'src="/image/single/{0}_300x168.jpg">'
+                '<span class="wallpapers__info-rating">{2:.1f}</span>'
+                '</a></li>'.format(wpid, resolution, rng.uniform(0, 10)))
+        pager = ''.join(
+            '<li><a class="pager__link" href="{}">{}</a></li>'.format(
+                page_href.format(n), n) for n in range(1, pages + 1))
+        return self.page(scope, (
+            '<div class="wallpapers"><ul class="wallpapers__list">{}</ul>'
+            '</div><ul class="pager__list">{}</ul>').format(
+                ''.join(items), pager))
+
+    def wallpaper(self, wpid: str) -> Response:
+        rng = self.rng(wpid)
+        tags = rng.sample(SYNTHETIC_TAGS, 4)
+        return self.page(wpid, (
+            '<div class="wallpaper__tags">{}</div>'
+            '<span class="wallpaper-votes__rate">{:.1f}</span>'
+            '<div class="author__block">'
+            '<div class="author__row">Author: Stand-in</div>'
+            '<div class="author__row">License: No license</div>'
+            '</div>').format(
+                ''.join('<a href="/tag/{0}">{0} wallpapers</a>'.format(t)
+                        for t in tags),
+                rng.uniform(0, 10)))
+
+    def download(self, wpid: str, resolution: str) -> Response:
+        return self.page(wpid, (
+            '<img class="wallpaper__image" src="/image/{}_{}.jpg">').format(
+                wpid, resolution))
+
+    def image(self, name: str) -> Response:
+        size = self.options.image_size
+        body = JPEG_HEADER + bytes(max(0, size - len(JPEG_HEADER)))
+        return 200, {'Content-Type': 'image/jpeg'}, body
+
+    def respond(self, method: str, path: str) -> Response:
+        url = urllib.parse.urlparse(path)
+        parts = [urllib.parse.unquote(p) for p in url.path.split('/') if p]
+        query = urllib.parse.parse_qs(url.query)
+        if method == 'POST':
+            return 200, {'Content-Type': 'application/json'}, b'{}'
+        if len(parts) >= 3 and parts[0] in ['catalog', 'tag']:
+            page_n = 1
+            if len(parts) >= 4 and parts[3].startswith('page'):
+                page_n = int(parts[3][4:])
+            href = "/{}/{}/{}/page{{}}".format(*parts[:3])
+            return self.listing('/'.join(parts[:2]), parts[2], page_n, href)
+        if parts == ['search']:
+            search = query.get('query', [''])[0]
+            size = query.get('size', [''])[0]
+            page_n = int(query.get('page', ['1'])[0])
+            href = "/search/?query={}&size={}&page={{}}".format(
+                urllib.parse.quote(search), size)
+            return self.listing('search/' + search, size, page_n, href)
+        if len(parts) == 2 and parts[0] == 'wallpaper':
+            return self.wallpaper(parts[1])
+        if len(parts) == 3 and parts[0] == 'download':
+            return self.download(parts[1], parts[2])
+        if len(parts) == 2 and parts[0] == 'image':
+            return self.image(parts[1])
+        return 404, {}, b"Not found"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Set by make_server() on a per-server subclass.
+    options: Options
+    recordings: Optional[Recordings]
+    synthetic: SyntheticSite
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        self.handle_request('GET')
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        self.handle_request('POST')
+
+    def forward(self, method: str) -> Response:
+        import requests
+        upstream = requests.request(method, self.options.upstream + self.path)
+        headers = {k: v for k, v in upstream.headers.items()
+                   if k.lower() in ['content-type', 'retry-after']}
+        return upstream.status_code, headers, upstream.content
+
+    def lookup(self, method: str) -> Response:
+        key = "{} {}".format(method, self.path)
+        response = self.recordings and self.recordings.get(key)
+        if response:
+            return response
+        if self.options.upstream:
+            response = self.forward(method)
+            if self.recordings is not None:
+                self.recordings.put(key, response)
+            return response
+        if self.options.pages:
+            return self.synthetic.respond(method, self.path)
+        return 404, {}, b"Not found"
+
+    def handle_request(self, method: str) -> None:
+        options = self.options
+        if options.latency:
+            time.sleep(options.latency)
+        roll = random.random()
+        if roll < options.error_rate:
+            response: Response = 500, {}, b"Internal Server Error"
+        elif roll < options.error_rate + options.throttle_rate:
+            response = 429, {'Retry-After': '1'}, b"Too Many Requests"
+        else:
+            response = self.lookup(method)
+        status, headers, body = response
+
+        # Support resuming image downloads.
+        byte_range = self.headers.get('Range', '')
+        offset = 0
+        if status == 200 and byte_range.startswith('bytes='):
+            offset = int(byte_range[6:].split('-')[0] or 0)
+            if offset >= len(body):
+                status, body, offset = 416, b"", 0
+            else:
+                status = 206
+                headers = dict(headers, **{
+                    'Content-Range': 'bytes {}-{}/{}'.format(
+                        offset, len(body) - 1, len(body))})
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body) - offset))
+        self.end_headers()
+        self.send_body(body[offset:])
+
+    def send_body(self, body: bytes) -> None:
+        bandwidth = self.options.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+            return
+        chunk_size = max(1, int(bandwidth / 10))
+        for i in range(0, len(body), chunk_size):
+            self.wfile.write(body[i:i + chunk_size])
+            time.sleep(chunk_size / bandwidth)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 makes concurrent crawls stall for a second
+    # on SYN retransmits.
+    request_queue_size = 128
+
+
+def make_server(options: Options, host: str='127.0.0.1',
+                port: int=0) -> HTTPServer:
+    # With port 0, a free port is picked; see server.server_address.
+    handler = type('Handler', (StandInHandler,), {
+        'options': options,
+        'recordings': (Recordings(options.record_dir)
+                       if options.record_dir else None),
+        'synthetic': SyntheticSite(options),
+    })
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def start_in_background(options: Options) -> Tuple[HTTPServer, str]:
+    # Returns the running server and its base URL.
+    server = make_server(options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, "http://{}:{}".format(host, port)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m wpcraft.standin.standin",
+        description="Local stand-in for wallpaperscraft.com.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Seconds added to every response.")
+    parser.add_argument('--bandwidth', type=float, default=0.0,
+                        help="Bytes per second per response, 0 is "
+                        "unlimited.")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with 500.")
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help="Fraction of requests answered with 429.")
+    parser.add_argument('--recordings', metavar='DIR',
+                        help="Replay responses recorded in DIR.")
+    parser.add_argument('--record', action="store_true",
+                        help="Forward requests missing from the recordings "
+                        "to wallpaperscraft.com and record the responses.")
+    parser.add_argument('--pages', type=int, default=20,
+                        help="Pages per scope of the synthetic site, 0 "
+                        "disables it.")
+    parser.add_argument('--per-page', type=int, default=15)
+    parser.add_argument('--image-size', type=int, default=256 * 1024,
+                        help="Size of synthetic images in bytes.")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.record and not args.recordings:
+        parser.error("--record requires --recordings")
+
+    options = Options(
+        latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+        record_dir=args.recordings,
+        upstream=UPSTREAM_URL if args.record else None,
+        pages=args.pages, per_page=args.per_page,
+        image_size=args.image_size, seed=args.seed)
+    server = make_server(options, args.host, args.port)
+    print("Serving on http://{}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,3 @@
+from .store import Store, ScopeIndex
+
+__all__ = ["Store", "ScopeIndex"]
@@ -0,0 +1,446 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from wpcraft.types import WPScope, WPID, Resolution
+
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS history (
+    pos INTEGER PRIMARY KEY AUTOINCREMENT,
+    wpid TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS marks (
+    set_name TEXT NOT NULL,
+    wpid TEXT NOT NULL,
+    added REAL NOT NULL,
+    PRIMARY KEY (set_name, wpid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tag_votes (
+    kind TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    votes INTEGER NOT NULL,
+    PRIMARY KEY (kind, tag)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tag_votes_done (
+    set_name TEXT NOT NULL,
+    wpid TEXT NOT NULL,
+    PRIMARY KEY (set_name, wpid)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scopes (
+    scope TEXT PRIMARY KEY,
+    indexed INTEGER NOT NULL DEFAULT 0,
+    updated REAL NOT NULL DEFAULT 0,
+    resolution TEXT,
+    npages INTEGER,
+    npages_updated REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS scope_entries (
+    scope TEXT NOT NULL,
+    wpid TEXT NOT NULL,
+    score REAL NOT NULL,
+    pos INTEGER NOT NULL,
+    PRIMARY KEY (scope, wpid)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS scope_entries_by_pos
+    ON scope_entries (scope, pos, score);
+CREATE TABLE IF NOT EXISTS scope_usage (
+    scope TEXT PRIMARY KEY,
+    used REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+class Store:
+    """SQLite database holding state, history, liked and disliked
+    wallpapers, tag votes and scope indexes.
+
+    Every change is written to the database right away, as a single row
+    where possible. The database is in WAL mode, so the background
+    prefetching process can read it while a command is writing. Tag votes
+    come in two kinds: 'current' totals, and the 'checkpoint' of a
+    recomputation in progress.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                  check_same_thread=False)
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Creating the schema takes a write lock, which is not needed once
+        # the database is up to date.
+        if self.query("PRAGMA user_version")[0][0] < SCHEMA_VERSION:
+            with self.transaction():
+                for statement in SCHEMA.split(';'):
+                    if statement.strip():
+                        self.db.execute(statement)
+                self.db.execute(
+                    "PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        self.state = State(self)
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        # Groups changes so that they are committed together. Transactions
+        # may be nested; only the outermost one commits.
+        with self.lock:
+            if self.depth == 0:
+                self.db.execute("BEGIN IMMEDIATE")
+            self.depth += 1
+            try:
+                yield self.db
+            except BaseException:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.db.execute("ROLLBACK")
+                raise
+            self.depth -= 1
+            if self.depth == 0:
+                self.db.execute("COMMIT")
+
+    def query(self, sql: str, *args) -> List[Tuple]:
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    def execute(self, sql: str, *args) -> None:
+        with self.lock:
+            self.db.execute(sql, args)
+
+    def close(self) -> None:
+        self.db.close()
+
+    # Internal flags.
+
+    def get_meta(self, key: str, default: Any=None) -> Any:
+        rows = self.query("SELECT value FROM meta WHERE key = ?", key)
+        return json.loads(rows[0][0]) if rows else default
+
+    def set_meta(self, key: str, value: Any) -> None:
+        self.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", key,
+                     json.dumps(value))
+
+    # History, newest first.
+
+    def history(self) -> List[WPID]:
+        return [WPID(w) for w, in self.query(
+            "SELECT wpid FROM history ORDER BY pos DESC")]
+
+    def push_history(self, wpid: WPID, size: int) -> None:
+        with self.transaction():
+            self.execute("INSERT INTO history (wpid) VALUES (?)", wpid)
+            self.execute("DELETE FROM history WHERE pos NOT IN ("
+                         "SELECT pos FROM history ORDER BY pos DESC "
+                         "LIMIT ?)", size)
+
+    # Liked and disliked wallpapers.
+
+    def is_marked(self, wpid: WPID, set_name: str) -> bool:
+        return bool(self.query(
+            "SELECT 1 FROM marks WHERE set_name = ? AND wpid = ?",
+            set_name, wpid))
+
+    def marked(self, set_name: str) -> List[WPID]:
+        return [WPID(w) for w, in self.query(
+            "SELECT wpid FROM marks WHERE set_name = ? ORDER BY added",
+            set_name)]
+
+    def count_marked(self, set_name: str) -> int:
+        return self.query("SELECT COUNT(*) FROM marks WHERE set_name = ?",
+                          set_name)[0][0]
+
+    def set_marked(self, wpid: WPID, set_name: str, val: bool) -> None:
+        if val:
+            self.execute("INSERT OR IGNORE INTO marks VALUES (?, ?, ?)",
+                         set_name, wpid, time.time())
+        else:
+            self.execute("DELETE FROM marks WHERE set_name = ? AND wpid = ?",
+                         set_name, wpid)
+
+    # Tag votes.
+
+    def tag_votes(self, kind: str='current') -> Dict[str, int]:
+        return dict(self.query(
+            "SELECT tag, votes FROM tag_votes WHERE kind = ?", kind))
+
+    def add_tag_vote(self, tag: str, change: int,
+                     kind: str='current') -> None:
+        with self.transaction():
+            self.execute("INSERT OR IGNORE INTO tag_votes VALUES (?, ?, 0)",
+                         kind, tag)
+            self.execute("UPDATE tag_votes SET votes = votes + ? "
+                         "WHERE kind = ? AND tag = ?", change, kind, tag)
+
+    def tag_votes_done(self) -> Set[Tuple[str, WPID]]:
+        return {(s, WPID(w)) for s, w in self.query(
+            "SELECT set_name, wpid FROM tag_votes_done")}
+
+    def is_tag_votes_done(self, wpid: WPID, set_name: str) -> bool:
+        return bool(self.query(
+            "SELECT 1 FROM tag_votes_done WHERE set_name = ? AND wpid = ?",
+            set_name, wpid))
+
+    def set_tag_votes_done(self, wpid: WPID, set_name: str) -> None:
+        self.execute("INSERT OR IGNORE INTO tag_votes_done VALUES (?, ?)",
+                     set_name, wpid)
+
+    def start_tag_votes_checkpoint(self) -> None:
+        with self.transaction():
+            self.execute("DELETE FROM tag_votes WHERE kind = 'checkpoint'")
+            self.execute("DELETE FROM tag_votes_done")
+            self.set_meta('votes-checkpoint', True)
+            self.set_meta('votes-pending', True)
+
+    def finish_tag_votes_checkpoint(self) -> None:
+        # The checkpoint becomes the current totals.
+        with self.transaction():
+            self.execute("DELETE FROM tag_votes WHERE kind = 'current'")
+            self.execute("UPDATE tag_votes SET kind = 'current' "
+                         "WHERE kind = 'checkpoint'")
+            self.execute("DELETE FROM tag_votes_done")
+            self.set_meta('votes-checkpoint', False)
+            self.set_meta('votes-pending', False)
+
+    # Scope indexes.
+
+    def clear_scopes(self, scope: Optional[WPScope]=None) -> None:
+        with self.transaction():
+            if scope is None:
+                self.execute("DELETE FROM scope_entries")
+                self.execute("DELETE FROM scopes")
+            else:
+                self.execute("DELETE FROM scope_entries WHERE scope = ?",
+                             scope)
+                self.execute("DELETE FROM scopes WHERE scope = ?", scope)
+
+    def touch_scope(self, scope: WPScope) -> None:
+        # Remembers when wallpapers were last picked from the scope. Kept
+        # apart from the indexes, so that it survives clearing them.
+        self.execute("INSERT OR REPLACE INTO scope_usage VALUES (?, ?)",
+                     scope, time.time())
+
+    def known_scopes(self) -> List[Tuple[WPScope, float, float]]:
+        # Every scope which was ever indexed, sampled or used, with the time
+        # its index was last updated (0 if there is none) and the time it
+        # was last used (0 if never).
+        rows = self.query(
+            "SELECT scope, MAX(updated), MAX(used) FROM ("
+            "  SELECT scope, CASE WHEN indexed THEN updated ELSE 0 END "
+            "    AS updated, 0 AS used FROM scopes"
+            "  UNION ALL SELECT scope, 0, used FROM scope_usage"
+            ") GROUP BY scope")
+        return [(WPScope(scope), updated, used)
+                for scope, updated, used in rows]
+
+    # Migration from the JSON files used by older versions.
+
+    def migrated(self) -> bool:
+        return self.get_meta('schema-version') is not None
+
+    def migrate(self, state_path: str, preferences_path: str,
+                scopes_dir: str) -> None:
+        # Imports the legacy state and preferences files and scope indexes,
+        # if there are any. The files are left in place, but never read
+        # again.
+        state = load_json(state_path)
+        preferences = load_json(preferences_path)
+        with self.transaction():
+            for key, value in state.items():
+                if key not in ['history', 'liked', 'disliked']:
+                    self.state[key] = value
+            for wpid in reversed(state.get('history', [])):
+                self.execute("INSERT INTO history (wpid) VALUES (?)", wpid)
+            # Even older versions kept the marks in the state file.
+            for set_name in ['liked', 'disliked']:
+                for wpid in (preferences.get(set_name, []) +
+                             state.get(set_name, [])):
+                    self.set_marked(WPID(wpid), set_name, True)
+            votes = preferences.get('votes')
+            for tag, v in (votes or {}).items():
+                self.add_tag_vote(tag, v)
+            checkpoint = preferences.get('votes-checkpoint')
+            if checkpoint:
+                self.set_meta('votes-checkpoint', True)
+                for tag, v in checkpoint['votes'].items():
+                    self.add_tag_vote(tag, v, 'checkpoint')
+                for set_name, wpids in checkpoint['done'].items():
+                    for wpid in wpids:
+                        self.set_tag_votes_done(WPID(wpid), set_name)
+            self.set_meta('votes-pending', votes is None and bool(
+                self.count_marked('liked') or self.count_marked('disliked')))
+            self.migrate_scopes(scopes_dir)
+            self.set_meta('schema-version', SCHEMA_VERSION)
+
+    def migrate_scopes(self, scopes_dir: str) -> None:
+        for directory, _, files in os.walk(scopes_dir):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(directory, name)
+                scope = WPScope(os.path.relpath(path, scopes_dir)[:-5])
+                data = load_json(path)
+                index = ScopeIndex(self, scope)
+                if data.get('npages') is not None:
+                    index.set_npages(data['npages'],
+                                     data.get('npages-updated', 0.0))
+                # Indexes written by older versions only hold IDs already
+                # filtered by score; they are useless without the scores.
+                if 'scores' in data and data.get('resolution'):
+                    w, h = data['resolution'].split('x')
+                    index.replace([(WPID(w), s) for w, s in data['scores']],
+                                  Resolution(int(w), int(h)),
+                                  data.get('updated', 0.0))
+
+
+def load_json(path: str) -> Dict[str, Any]:
+    try:
+        return json.load(open(path, 'r'))
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return {}
+
+
+class State(MutableMapping):
+    """Dictionary-like view of the 'state' table, with JSON values."""
+    def __init__(self, store: Store) -> None:
+        self.store = store
+
+    def __getitem__(self, key: str) -> Any:
+        rows = self.store.query("SELECT value FROM state WHERE key = ?", key)
+        if not rows:
+            raise KeyError(key)
+        return json.loads(rows[0][0])
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self.store.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", key,
+                           json.dumps(value))
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self.store.execute("DELETE FROM state WHERE key = ?", key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter([k for k, in self.store.query("SELECT key FROM state")])
+
+    def __len__(self) -> int:
+        return self.store.query("SELECT COUNT(*) FROM state")[0][0]
+
+
+class ScopeIndex:
+    """List of wallpapers available in a scope, with their listing scores.
+
+    The index is stored unfiltered, newest wallpapers first; the min-score
+    setting is applied when IDs are selected from it.
+    """
+    def __init__(self, store: Store, scope: WPScope) -> None:
+        self.store = store
+        self.scope = scope
+        self.indexed = False
+        self.updated = 0.0
+        # Resolution the listing was fetched for, as "WxH".
+        self.resolution: Optional[str] = None
+        # Number of listing pages, remembered separately so that scopes
+        # which are only sampled don't have to ask for it on every use.
+        self.npages: Optional[int] = None
+        self.npages_updated = 0.0
+        rows = store.query("SELECT indexed, updated, resolution, npages, "
+                           "npages_updated FROM scopes WHERE scope = ?",
+                           scope)
+        if rows:
+            (indexed, self.updated, self.resolution, self.npages,
+             self.npages_updated) = rows[0]
+            self.indexed = bool(indexed)
+
+    def exists(self) -> bool:
+        return self.indexed
+
+    def wpids(self, min_score: Optional[float]=None) -> List[WPID]:
+        # Large scopes hold tens of thousands of wallpapers, the IDs are
+        # returned as they come from the database.
+        if not min_score:
+            rows = self.store.query(
+                "SELECT wpid FROM scope_entries WHERE scope = ? "
+                "ORDER BY pos", self.scope)
+        else:
+            rows = self.store.query(
+                "SELECT wpid FROM scope_entries WHERE scope = ? "
+                "AND score >= ? ORDER BY pos", self.scope, min_score)
+        return [w for w, in rows]
+
+    def count(self, min_score: Optional[float]=None) -> int:
+        return self.store.query(
+            "SELECT COUNT(*) FROM scope_entries WHERE scope = ? "
+            "AND score >= ?", self.scope, min_score or 0.0)[0][0]
+
+    def fetched_in(self, resolution: Resolution) -> bool:
+        # Whether the listing was fetched for the given resolution; listings
+        # differ between resolutions, so others need a full refresh.
+        return self.resolution == "{}x{}".format(resolution.w, resolution.h)
+
+    def lists(self, wpid: WPID, resolution: Resolution) -> bool:
+        # Whether the wallpaper was listed when browsing this scope in the
+        # given resolution, which means it is available in it.
+        if not self.fetched_in(resolution):
+            return False
+        return bool(self.store.query(
+            "SELECT 1 FROM scope_entries WHERE scope = ? AND wpid = ?",
+            self.scope, wpid))
+
+    def known(self) -> Set[WPID]:
+        return {WPID(w) for w, in self.store.query(
+            "SELECT wpid FROM scope_entries WHERE scope = ?", self.scope)}
+
+    def write_row(self) -> None:
+        self.store.execute(
+            "INSERT OR REPLACE INTO scopes VALUES (?, ?, ?, ?, ?, ?)",
+            self.scope, int(self.indexed), self.updated, self.resolution,
+            self.npages, self.npages_updated)
+
+    def replace(self, entries: List[Tuple[WPID, float]],
+                resolution: Resolution,
+                updated: Optional[float]=None) -> None:
+        with self.store.transaction() as db:
+            db.execute("DELETE FROM scope_entries WHERE scope = ?",
+                       (self.scope,))
+            db.executemany(
+                "INSERT OR IGNORE INTO scope_entries VALUES (?, ?, ?, ?)",
+                ((self.scope, w, s, pos)
+                 for pos, (w, s) in enumerate(entries)))
+            self.indexed = True
+            self.resolution = "{}x{}".format(resolution.w, resolution.h)
+            self.updated = time.time() if updated is None else updated
+            self.write_row()
+
+    def add_new(self, entries: List[Tuple[WPID, float]]) -> None:
+        # New entries go in front, keeping the newest-first order.
+        with self.store.transaction() as db:
+            first = db.execute(
+                "SELECT MIN(pos) FROM scope_entries WHERE scope = ?",
+                (self.scope,)).fetchone()[0] or 0
+            db.executemany(
+                "INSERT OR IGNORE INTO scope_entries VALUES (?, ?, ?, ?)",
+                ((self.scope, w, s, first - len(entries) + pos)
+                 for pos, (w, s) in enumerate(entries)))
+            self.updated = time.time()
+            self.write_row()
+
+    def set_npages(self, npages: int, updated: Optional[float]=None) -> None:
+        self.npages = npages
+        self.npages_updated = time.time() if updated is None else updated
+        with self.store.transaction():
+            self.write_row()
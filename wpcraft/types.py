@@ -18,4 +18,12 @@ class Resolution(NamedTuple):
     h: int
 
 
-__all__ = ["WPScope", "WPID", "WPData", "Resolution"]
+class Monitor(NamedTuple):
+    name: str
+    resolution: Resolution
+    x: int
+    y: int
+    primary: bool
+
+
+__all__ = ["WPScope", "WPID", "WPData", "Resolution", "Monitor"]
@@ -1,3 +1,10 @@
-from .utils import get_screen_resolution, set_wallpaper_gnome3
+from .utils import (get_screen_resolution, get_screen_resolutions,
+                    get_monitors, parse_xrandr, display_fingerprint,
+                    file_lock, write_json_atomically, LazyModule,
+                    find_dbus_session, dbus_session_alive,
+                    session_environ)
 
-__all__ = ["get_screen_resolution", "set_wallpaper_gnome3"]
+__all__ = ["get_screen_resolution", "get_screen_resolutions", "get_monitors",
+           "parse_xrandr", "display_fingerprint", "file_lock",
+           "write_json_atomically", "LazyModule", "find_dbus_session",
+           "dbus_session_alive", "session_environ"]
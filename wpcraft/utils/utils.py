@@ -1,41 +1,284 @@
 import os
-import subprocess
+import re
+import sys
+import json
+import fcntl
+import types
+import zlib
+import importlib
+from contextlib import contextmanager
+from typing import (Any, Callable, Dict, Iterator, List, Optional,
+                    Sequence, Tuple)
 
-from wpcraft.types import Resolution
+from wpcraft.types import Resolution, Monitor
 
 
-def set_wallpaper_gnome3(path) -> None:
-    command = ("gsettings set org.gnome.desktop.background "
-               "picture-uri file://{}".format(path))
-    os.system(command)
+class LazyModule(types.ModuleType):
+    """Stand-in for a module which is only imported once one of its
+    attributes is used.
 
+    Keeps dependencies such as requests and bs4 from being loaded by
+    commands which never touch the network.
+    """
+    def __init__(self, name: str,
+                 requires: Sequence["LazyModule"]=()) -> None:
+        # requires lists lazy modules which the module imports itself; they
+        # are loaded through their proxies first, so that their callbacks
+        # run before the module uses them.
+        super().__init__(name)
+        self.__dict__['_callbacks'] = []
+        self.__dict__['_requires'] = list(requires)
 
-def get_screen_resolution() -> Resolution:
+    def when_imported(self, callback: Callable[[Any], None]) -> None:
+        # Calls callback with the module once it is imported, or right away
+        # if it already is.
+        if self.__name__ in sys.modules:
+            callback(sys.modules[self.__name__])
+        else:
+            self._callbacks.append(callback)
+
+    def load(self) -> Any:
+        for required in self._requires:
+            required.load()
+        module = importlib.import_module(self.__name__)
+        callbacks, self.__dict__['_callbacks'] = self._callbacks, []
+        for callback in callbacks:
+            callback(module)
+        return module
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(self.load(), attr)
+
+
+@contextmanager
+def file_lock(path: str) -> Iterator[None]:
+    # Exclusive lock shared by all processes which modify the file at path,
+    # held on an accompanying lock file.
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def write_json_atomically(path: str, data: Any, **kwargs) -> None:
+    # The document is written to a temporary file which then replaces the
+    # target, so that readers never see a partially written file, even if
+    # the process is killed or the system crashes in the middle of a write.
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    # Make the rename itself durable.
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+DBUS_KEY = "DBUS_SESSION_BUS_ADDRESS"
+# Processes which are expected to have the session bus address set, in
+# order of preference. The address is looked for in their environment before
+# that of any other process.
+SESSION_PROCESSES = ["gnome-session", "gnome-session-b", "gnome-shell",
+                     "xfce4-session", "mate-session", "dbus-daemon",
+                     "dbus-broker"]
+
+
+def read_proc_file(proc_root: str, pid: int, name: str) -> Optional[str]:
+    # Processes may exit, or turn out to be inaccessible, at any point.
+    try:
+        with open(os.path.join(proc_root, str(pid), name), 'rb') as f:
+            return f.read().decode('utf-8', 'replace')
+    except (PermissionError, FileNotFoundError, ProcessLookupError):
+        return None
+
+
+def dbus_address_in_environ(environ: str) -> Optional[str]:
+    prefix = DBUS_KEY + "="
+    for e in environ.split('\0'):
+        if e.startswith(prefix):
+            return e[len(prefix):]
+    return None
+
+
+def session_environ(pid: int, names: Sequence[str],
+                    proc_root: str="/proc") -> Dict[str, str]:
+    # The given variables, where set, from the environment of a process of
+    # the user's session, e.g. the one find_dbus_session found.
+    environ = read_proc_file(proc_root, pid, "environ") or ""
+    found = {}
+    for e in environ.split('\0'):
+        key, sep, value = e.partition('=')
+        if sep and key in names:
+            found[key] = value
+    return found
+
+
+def dbus_session_alive(address: str, pid: int,
+                       proc_root: str="/proc") -> bool:
+    # Cheap check whether a previously found session bus is still usable:
+    # the process it was found in is still running with the same address,
+    # and the bus socket, unless it is an abstract one, still exists.
+    environ = read_proc_file(proc_root, pid, "environ")
+    if environ is None or dbus_address_in_environ(environ) != address:
+        return False
+    for part in address.split(';')[0].split(':', 1)[-1].split(','):
+        key, _, value = part.partition('=')
+        if key == 'path' and not os.path.exists(value):
+            return False
+    return True
+
+
+def find_dbus_session(proc_root: str="/proc",
+                      uid: Optional[int]=None) -> Optional[Tuple[str, int]]:
+    # Looks for the session bus address in the environment of the user's
+    # processes. Returns the address and the PID of the process it was found
+    # in, or None.
+    if uid is None:
+        uid = os.getuid()
+
+    def address_of(pid: int) -> Optional[str]:
+        environ = read_proc_file(proc_root, pid, "environ")
+        return environ and dbus_address_in_environ(environ)
+
+    # The most preferred session process is checked as soon as it is found,
+    # other session processes in order of preference once all are known, and
+    # the environment of any other process only if none of them has it.
+    session: List[Tuple[int, int]] = []
+    others: List[int] = []
+    for entry in os.listdir(proc_root):
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        try:
+            if os.stat(os.path.join(proc_root, entry)).st_uid != uid:
+                continue
+        except FileNotFoundError:
+            continue
+        comm = read_proc_file(proc_root, pid, "comm")
+        if comm is None:
+            continue
+        comm = comm.strip()
+        if comm not in SESSION_PROCESSES:
+            others.append(pid)
+        elif comm == SESSION_PROCESSES[0]:
+            address = address_of(pid)
+            if address:
+                return address, pid
+        else:
+            session.append((SESSION_PROCESSES.index(comm), pid))
+
+    for rank, pid in sorted(session):
+        address = address_of(pid)
+        if address:
+            return address, pid
+    for pid in others:
+        # Kernel threads and zombies have no command line, nor environment.
+        if not read_proc_file(proc_root, pid, "cmdline"):
+            continue
+        address = address_of(pid)
+        if address:
+            return address, pid
+    return None
+
+
+# A connected output of xrandr, with its current mode and position, e.g.
+# "HDMI-1 connected primary 1920x1080+0+0 (normal left inverted ...".
+XRANDR_OUTPUT = re.compile(
+    r'^(\S+) connected (primary )?(\d+)x(\d+)\+(\d+)\+(\d+)')
+
+
+def parse_xrandr(output: str) -> List[Monitor]:
+    monitors = []
+    for line in output.split('\n'):
+        match = XRANDR_OUTPUT.match(line)
+        if match:
+            name, primary, w, h, x, y = match.groups()
+            monitors.append(Monitor(name, Resolution(int(w), int(h)),
+                                    int(x), int(y), bool(primary)))
+    if not monitors:
+        # Older versions only mark the current mode with a '*'.
+        for n, line in enumerate(l for l in output.split('\n') if '*' in l):
+            w, h = line.split()[0].split('x', 1)
+            monitors.append(Monitor("screen{}".format(n),
+                                    Resolution(int(w), int(h)), 0, 0, n == 0))
+    # The primary monitor goes first, then the rest in the order of xrandr,
+    # which is also the order of Xinerama screens.
+    monitors.sort(key=lambda m: not m.primary)
+    return monitors
+
+
+def get_monitors() -> List[Monitor]:
     # There are various ways to query screen resolution, but most of them
     # require a specific tool to be available on the target system.
 
     # First, try pygtk.
     try:
         import gtk
-        return Resolution(w=gtk.gdk.screen_width(),
-                          h=gtk.gdk.screen_height())
+        return [Monitor("screen0", Resolution(w=gtk.gdk.screen_width(),
+                                              h=gtk.gdk.screen_height()),
+                        0, 0, True)]
     except (ImportError, ModuleNotFoundError):
         pass
 
     # Then, try xrandr.
+    import subprocess
     try:
         cmd = ['xrandr']
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
         xrandr, _ = p.communicate()
-        resolution_lines = [l for l in xrandr.decode('ascii').split('\n')
-                            if '*' in l]
-
-        # TODO: What if there are multiple displays with different resolutions?
-        resolution = resolution_lines[0].split()[0]
-        w, h = resolution.split('x', 1)
-
-        return Resolution(int(w), int(h))
+        monitors = parse_xrandr(xrandr.decode('ascii', 'replace'))
+        if monitors:
+            return monitors
     except FileNotFoundError:
         pass
 
     exit("Unable to determine screen resolution.")
+
+
+def get_screen_resolutions() -> List[Resolution]:
+    # Distinct resolutions of all monitors, the primary one's first.
+    resolutions: List[Resolution] = []
+    for monitor in get_monitors():
+        if monitor.resolution not in resolutions:
+            resolutions.append(monitor.resolution)
+    return resolutions
+
+
+def get_screen_resolution() -> Resolution:
+    return get_screen_resolutions()[0]
+
+
+def display_fingerprint(drm_root: str="/sys/class/drm") -> str:
+    # Changes whenever a monitor is connected, disconnected, enabled,
+    # disabled or swapped for another one. Reading these few sysfs files is
+    # much cheaper than running xrandr. Only what is the same for cron jobs
+    # and interactive commands of the same session is included.
+    parts = [os.getenv("DISPLAY", "")]
+    try:
+        connectors = sorted(os.listdir(drm_root))
+    except FileNotFoundError:
+        connectors = []
+    for connector in connectors:
+        for name in ["status", "enabled", "edid"]:
+            try:
+                with open(os.path.join(drm_root, connector, name),
+                          'rb') as f:
+                    value = f.read()
+            except OSError:
+                continue
+            if name == "edid":
+                value = b"%08x" % zlib.crc32(value)
+            parts.append("{}/{}={}".format(
+                connector, name, value.decode('utf-8', 'replace').strip()))
+    return "\n".join(parts)
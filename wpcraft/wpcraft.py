@@ -1,41 +1,64 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
+import copy
 import json
 import time
-import shutil
+import fcntl
 import random
-import requests
 import datetime
-import argparse
-import subprocess
-from contextlib import contextmanager
-from typing import Dict, Any, Optional, List, Set
+import traceback
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from typing import (Dict, Any, Optional, List, Set, Iterator, Tuple,
+                    Callable)
 
-from crontab import CronTab
-
-from wpcraft.wpcraftaccess import wpcraftaccess as wpa
 from wpcraft.utils import utils
-from wpcraft.types import WPScope, WPID, WPData, Resolution
+from wpcraft.profiling import profiling
+from wpcraft.cache import (WPDataCache, ImageUrlCache, PrefetchQueue,
+                           ImageCache)
+from wpcraft.store import Store, ScopeIndex
+from wpcraft.types import WPScope, WPID, WPData, Resolution, Monitor
+
+# Network access pulls in requests, bs4 and asyncio, which take longer to
+# import than most commands take to run. They are only imported once used.
+wpa = utils.LazyModule("wpcraft.wpcraftaccess.wpcraftaccess")
+asyncaccess = utils.LazyModule("wpcraft.wpcraftaccess.asyncaccess",
+                               requires=[wpa])
+daemon = utils.LazyModule("wpcraft.daemon.daemon")
+backends = utils.LazyModule("wpcraft.backends.backends")
+mirror = utils.LazyModule("wpcraft.mirror.mirror")
 
 CONFIG_FILE_PATH = (os.getenv("WPCRAFT_CONFIG") or
                     "~/.local/share/wpcraft/config.json")
 
-# TODO: These dictionaries could be TypedDicts instead.
+# TODO: This dictionary could be a TypedDict instead.
 DEFAULT_CONFIG: Dict[str, Any] = {
     "state-path": "~/.local/share/wpcraft/state.json",
     "preferences-path": "~/.local/share/wpcraft/preferences.json",
+    "store-path": "~/.local/share/wpcraft/wpcraft.db",
     "cache-dir": "~/.cache/wpcraft",
     "scope": "catalog/city",
     "resolution": "default",
     "history-size": 20,
-    "min-score": 0.0
-}
-DEFAULT_STATE: Dict[str, Any] = {}
-DEFAULT_PREFERENCES: Dict[str, Any] = {
-    "liked": [],
-    "disliked": []
+    "min-score": 0.0,
+    "wpdata-cache-days": 30,
+    "wpdata-cache-size": 10000,
+    "rate-limits": {},
+    "sample-min-pages": 10,
+    "prefetch-count": 3,
+    "cache-max-mb": 1024,
+    "cache-max-files": 500,
+    "cache-policy": "lru",
+    "image-url-cache-size": 20000,
+    "base-url": None,
+    # How the wallpaper is set: auto, gnome, cinnamon, mate, xfce, feh, file
+    # (only records the path in backend-file) or none.
+    "backend": "auto",
+    "backend-file": "~/.cache/wpcraft/wallpaper.json",
+    # Defaults to wpcraft.sock in $XDG_RUNTIME_DIR, or in cache-dir.
+    "daemon-socket": None
 }
 
 SET_VOTES = {
@@ -43,35 +66,56 @@ SET_VOTES = {
     'disliked': -1
 }
 
+# Metadata for tag votes is fetched by this many threads at once. The shared
+# rate limiter in wpcraftaccess is what actually paces the requests, this only
+# needs to be large enough to keep it saturated.
+TAG_RECOMPUTE_WORKERS = 8
+# Recomputation progress is checkpointed after every batch of this size.
+TAG_RECOMPUTE_BATCH = 50
+
+# `update --all` refreshes this many scopes at once. All of them share the
+# rate limits of wpcraftaccess, so this only needs to be large enough to keep
+# them busy.
+UPDATE_ALL_WORKERS = 4
+# Scopes are refreshed in order of how stale their index is, weighted by how
+# recently they were used: the weight halves for every this many seconds
+# since the last use, down to UPDATE_ALL_MIN_WEIGHT.
+UPDATE_ALL_USAGE_HALF_LIFE = 7 * 24 * 3600
+UPDATE_ALL_MIN_WEIGHT = 0.05
+# Scopes without an index count as this many seconds stale.
+UPDATE_ALL_UNINDEXED_AGE = 30 * 24 * 3600
+
+# How many random pages of a scope are tried when sampling, before giving up.
+SAMPLE_ATTEMPTS = 5
+# Page counts of sampled scopes are refreshed after this many seconds.
+NPAGES_MAX_AGE = 24 * 3600
+
+# Wallpapers missing in some resolution are checked again after this many
+# seconds.
+UNAVAILABLE_IMAGE_MAX_AGE = 7 * 24 * 3600
+
+# Detected monitors are kept until the display configuration changes. Mode
+# changes of a connected monitor do not show in sysfs, so they are detected
+# again after this many seconds regardless.
+MONITORS_MAX_AGE = 3600
+
+# Score thresholds for which `status` shows the number of matching wallpapers.
+STATUS_SCORE_THRESHOLDS = [5.0, 6.0, 7.0, 8.0, 9.0]
+
+# Commands which are forwarded to `wpcraft daemon`, if it is running.
+DAEMON_COMMANDS = ['next', 'prev', 'like', 'dislike', 'unlike', 'status']
+# After a scheduled switch fails (e.g. with no network), the daemon tries
+# again after this many seconds.
+DAEMON_RETRY_DELAY = 60
+
 CRONTAB_COMMENT = 'wpcraft_automatically_generated'
 
-THIS_FILE = os.path.realpath(__file__)
 CRON_COMMAND = "python3 -m wpcraft.wpcraft"
 
 
-@contextmanager
-def data_in_json_file(path: str, default: Dict[str, Any]):
-    fullpath = os.path.expanduser(path)
-    if not os.path.exists(fullpath):
-        data = default.copy()
-    else:
-        if os.path.exists(fullpath):
-            try:
-                data = json.load(open(fullpath, 'r'))
-            except json.decoder.JSONDecodeError:
-                data = default.copy()
-        else:
-            os.makedirs(os.path.dirname(fullpath))
-            data = default.copy()
-
-    yield data
-
-    os.makedirs(os.path.dirname(fullpath), exist_ok=True)
-    json.dump(data, open(fullpath, 'w'), indent=4)
-
-
 @contextmanager
 def user_crontab():
+    from crontab import CronTab
     cron = CronTab(user=True)
     yield cron
     cron.write_to_user(user=True)
@@ -80,62 +124,112 @@ def user_crontab():
 class WPCraft:
     def __init__(self, config_path: str) -> None:
         self.config_path = os.path.expanduser(config_path)
-
-        # Load config
+        self.load_config()
+
+        # State, preferences and scope indexes live in a database. Older
+        # versions stored them in JSON files, which are imported once.
+        self.store = Store(self.config_get_filesystem_path("store-path"))
+        if not self.store.migrated():
+            self.store.migrate(
+                self.config_get_filesystem_path("state-path"),
+                self.config_get_filesystem_path("preferences-path"),
+                os.path.join(self.config_get_filesystem_path("cache-dir"),
+                             "by_scope"))
+        self.state = self.store.state
+
+        wpa.when_imported(self.configure_access)
+
+        self.backend = None
+        # Detected monitors, with the display fingerprint they are valid for.
+        self.monitors: Optional[Tuple[str, List[Monitor]]] = None
+
+        # Within `wpcraft daemon`, prefetching is done by the daemon itself
+        # once it is idle, rather than by a separate process.
+        self.prefetch_in_process = False
+        self.prefetch_requested = False
+
+        self.wpdata_cache = WPDataCache(
+            os.path.join(self.config_get_filesystem_path("cache-dir"),
+                         "wpdata.json"),
+            ttl=self.config_get("wpdata-cache-days") * 24 * 3600,
+            max_entries=self.config_get("wpdata-cache-size"))
+
+        self.image_url_cache = ImageUrlCache(
+            os.path.join(self.config_get_filesystem_path("cache-dir"),
+                         "image_urls.json"),
+            negative_ttl=UNAVAILABLE_IMAGE_MAX_AGE,
+            max_entries=self.config_get("image-url-cache-size"))
+        self.scope_indexes: Dict[WPScope, ScopeIndex] = {}
+
+        self.image_cache = ImageCache(
+            self.config_get_filesystem_path("cache-dir"),
+            max_bytes=self.config_get("cache-max-mb") * 1024 * 1024,
+            max_files=self.config_get("cache-max-files"),
+            policy=self.config_get("cache-policy"))
+
+    def load_config(self) -> None:
+        # A copy of what was loaded is kept, so that save() knows which
+        # settings were changed.
+        self.loaded_config: Dict[str, Any] = {}
+        self.config_mtime = None
         try:
             self.config = json.load(open(self.config_path, 'r'))
-        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-            print("Config file is missing or corrupted, using default.")
-            self.config = DEFAULT_CONFIG
-
-        # Load state
-        state_file_path = self.config_get_filesystem_path("state-path")
+            self.loaded_config = copy.deepcopy(self.config)
+            self.config_mtime = os.path.getmtime(self.config_path)
+        except FileNotFoundError:
+            print("Config file is missing, using default.")
+            self.config = dict(DEFAULT_CONFIG)
+        except json.decoder.JSONDecodeError:
+            # Keep the broken file around, the user may want to fix it.
+            os.replace(self.config_path, self.config_path + ".corrupted")
+            print("Config file is corrupted, using default. The old file "
+                  "was moved to {}.corrupted".format(self.config_path))
+            self.config = dict(DEFAULT_CONFIG)
+
+    def reload_config(self) -> None:
+        # Picks up changes made by other processes, for long-running
+        # instances such as the daemon.
         try:
-            self.state = json.load(open(state_file_path, 'r'))
-        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-            print("State file is missing or corrupted, using default.")
-            self.state = DEFAULT_STATE
+            mtime = os.path.getmtime(self.config_path)
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.config_mtime:
+            return
+        self.load_config()
+        wpa.when_imported(self.configure_access)
 
-        preferences_file_path = self.config_get_filesystem_path("preferences-path")
-        try:
-            self.preferences = json.load(open(preferences_file_path, 'r'))
-        except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
-            print("Preferences file is missing or corrupted, using default.")
-            self.preferences = DEFAULT_PREFERENCES
-
-        # Initialize tag votes, if they are missing from the preferences file.
-        if ('votes' not in self.preferences
-           or self.preferences['votes'] is None):
-            if (self.preferences.get("liked", [])
-               or self.preferences.get("disliked", [])):
-                print("Recomputing tag votes, please wait...")
-                self.recompute_all_tags()
+    def configure_access(self, access) -> None:
+        access.configure_rate_limits(self.config_get("rate-limits"))
+        if self.config_get("base-url"):
+            access.set_base_url(self.config_get("base-url"))
 
     def save(self) -> None:
-        # If the state contains preferences, move them to the preferences
-        # file. This is to support legacy configs where preferences were
-        # stored in the state file.
-        if 'liked' in self.state:
-            self.preferences['liked'].extend(self.state['liked'])
-            del self.state['liked']
-        if 'disliked' in self.state:
-            self.preferences['disliked'].extend(self.state['disliked'])
-            del self.state['disliked']
-
-        # Save state
-        state_file = self.config_get_filesystem_path("state-path")
-        os.makedirs(os.path.dirname(state_file), exist_ok=True)
-        json.dump(self.state, open(state_file, 'w'), indent=4)
-
-        # Save preferences
-        preferences_file = self.config_get_filesystem_path("preferences-path")
-        os.makedirs(os.path.dirname(preferences_file), exist_ok=True)
-        json.dump(self.preferences, open(preferences_file, 'w'), indent=4,
-                  sort_keys=True)
-
-        # Save config
-        os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-        json.dump(self.config, open(self.config_path, 'w'), indent=4)
+        # State and preferences are written to the store as they change.
+
+        # Save config, if any setting was changed. Another process may have
+        # changed other settings in the meantime, so only ours are written
+        # over the current contents of the file.
+        changed = [k for k in set(self.config) | set(self.loaded_config)
+                   if self.config.get(k, KeyError) !=
+                   self.loaded_config.get(k, KeyError)]
+        if changed:
+            with utils.file_lock(self.config_path):
+                try:
+                    config = json.load(open(self.config_path, 'r'))
+                except (FileNotFoundError, json.decoder.JSONDecodeError):
+                    config = {}
+                for k in changed:
+                    if k in self.config:
+                        config[k] = self.config[k]
+                    else:
+                        config.pop(k, None)
+                utils.write_json_atomically(self.config_path, config,
+                                            indent=4)
+            self.loaded_config = copy.deepcopy(self.config)
+            self.config_mtime = os.path.getmtime(self.config_path)
+
+        self.wpdata_cache.save()
+        self.image_url_cache.save()
 
     def config_get(self, path: str):
         if path in self.config:
@@ -146,62 +240,260 @@ class WPCraft:
         return os.path.abspath(os.path.expanduser(self.config_get(path)))
 
     def get_wpdata(self, id: WPID) -> Optional[WPData]:
-        # TODO: Maybe cache wpdata, or is it unnecessary?
-        return wpa.get_wpdata(id)
+        wpdata = self.wpdata_cache.get(id)
+        if wpdata is None:
+            wpdata = wpa.get_wpdata(id)
+            if wpdata is not None:
+                self.wpdata_cache.put(wpdata)
+        return wpdata
+
+    def get_scope_index(self, scope: WPScope) -> ScopeIndex:
+        if scope not in self.scope_indexes:
+            self.scope_indexes[scope] = ScopeIndex(self.store, scope)
+        return self.scope_indexes[scope]
+
+    def prefetch_wpdata(self, wpids: List[WPID]) -> None:
+        # Fetches metadata of all given wallpapers missing from the cache at
+        # once, using the async access layer.
+        missing = [w for w in wpids if self.wpdata_cache.get(w) is None]
+        for wpdata in asyncaccess.get_wpdata_many(missing).values():
+            if wpdata is not None:
+                self.wpdata_cache.put(wpdata)
 
     def get_wpids(self, scope: WPScope=None,
-                  clear_cache=False) -> List[WPID]:
+                  clear_cache=False, incremental=False) -> List[WPID]:
+        # With incremental=True, an existing index is refreshed by fetching
+        # only the listing pages newer than anything it already contains.
         if scope is None:
             scope = WPScope(self.config_get("scope"))
-        if scope == "liked":
-            return self.preferences.get("liked", [])
-        if scope == "disliked":
-            return self.preferences.get("disliked", [])
-        cache_dir = self.config_get_filesystem_path("cache-dir")
-        os.makedirs(cache_dir, exist_ok=True)
-        path = os.path.join(cache_dir, "by_scope", str(scope) + ".json")
-        with data_in_json_file(path, {}) as data:
-            if clear_cache:
-                data.clear()
-            if 'ids' in data:
-                return data['ids']
-            min_score = self.config_get('min-score')
-            data['ids'] = wpa.get_wpids(
-                scope, self.get_resolution(), min_score)
-            return data['ids']
+        if scope in ["liked", "disliked"]:
+            return self.store.marked(scope)
+        index = self.get_scope_index(scope)
+        resolution = self.get_resolution()
+        new = None
+        if (incremental and not clear_cache and index.exists() and
+                index.fetched_in(resolution)):
+            # None if the index is too far behind to catch up page by page.
+            new = wpa.get_new_wpid_scores(scope, resolution, index.known())
+        if new is not None:
+            index.add_new(new)
+            print("{} new wallpapers found.".format(len(new)))
+        elif clear_cache or not index.exists() or incremental:
+            profiling.count("scope-index.miss")
+            if asyncaccess.available():
+                entries = asyncaccess.get_wpid_scores(scope, resolution)
+            else:
+                entries = wpa.get_wpid_scores(scope, resolution)
+            index.replace(entries, resolution)
+        return index.wpids(self.config_get('min-score'))
+
+    def get_npages(self, scope: WPScope, index: ScopeIndex) -> int:
+        if (index.npages is None or
+                time.time() - index.npages_updated > NPAGES_MAX_AGE):
+            index.set_npages(wpa.get_npages(scope, self.get_resolution()))
+        return index.npages
+
+    def should_sample(self, scope: WPScope) -> bool:
+        # Large scopes without an index are sampled instead of crawled.
+        sample_min_pages = self.config_get("sample-min-pages")
+        if not sample_min_pages or scope in ["liked", "disliked"]:
+            return False
+        index = self.get_scope_index(scope)
+        if index.exists():
+            return False
+        return self.get_npages(scope, index) >= sample_min_pages
+
+    def iter_sampled_wpids(self, scope: WPScope) -> Iterator[List[WPID]]:
+        # Yields IDs from a uniformly chosen random listing page of the
+        # scope, as many times as the caller asks for another one. Only one
+        # request is made per page, no index is built.
+        index = self.get_scope_index(scope)
+        npages = self.get_npages(scope, index)
+        min_score = self.config_get('min-score')
+        resolution = self.get_resolution()
+        for n in random.sample(range(npages), min(npages, SAMPLE_ATTEMPTS)):
+            entries = wpa.get_page_entries(scope, resolution, n) or []
+            # Everything listed is available in this resolution.
+            for identifier, score in entries:
+                self.image_url_cache.store(
+                    identifier, resolution,
+                    wpa.listed_image_url(identifier, resolution))
+            yield [identifier for identifier, score in entries
+                   if not min_score or (score >= min_score)]
+
+    def iter_wpids(self, scope: WPScope=None) -> Iterator[List[WPID]]:
+        # Yields batches of IDs available in the scope. If there is no index
+        # for it yet, the scope is crawled and IDs are yielded page by page,
+        # as soon as each page arrives; the index is stored once the crawl
+        # completes.
+        if scope is None:
+            scope = WPScope(self.config_get("scope"))
+        if scope in ["liked", "disliked"]:
+            yield self.get_wpids(scope)
+            return
+        index = self.get_scope_index(scope)
+        if index.exists():
+            profiling.count("scope-index.hit")
+            yield index.wpids(self.config_get('min-score'))
+            return
+        profiling.count("scope-index.miss")
+        min_score = self.config_get('min-score')
+        resolution = self.get_resolution()
+        pages = []
+        for n, entries in wpa.iter_wpid_scores(scope, resolution,
+                                               index.npages):
+            pages.append((n, entries))
+            yield [identifier for identifier, score in entries
+                   if not min_score or (score >= min_score)]
+        index.replace(wpa.merge_pages(pages), resolution)
 
     def invalidate_scope_cache(self) -> None:
-        cache_dir = self.config_get_filesystem_path("cache-dir")
-        shutil.rmtree(os.path.join(cache_dir, "by_scope"))
-
-    def get_resolution(self) -> Resolution:
+        self.store.clear_scopes()
+        self.scope_indexes = {}
+
+    def get_monitors(self) -> List[Monitor]:
+        # Running xrandr takes longer than the rest of a cached `next`, so
+        # monitors are remembered for as long as the display configuration
+        # stays the same, both in this process and in the state.
+        fingerprint = utils.display_fingerprint()
+        if self.monitors is not None and self.monitors[0] == fingerprint:
+            return self.monitors[1]
+        cached = self.state.get('monitors')
+        if (cached and cached['fingerprint'] == fingerprint and
+                time.time() - cached['detected'] < MONITORS_MAX_AGE):
+            profiling.count("monitors.hit")
+            monitors = [Monitor(name, Resolution(w, h), x, y, primary)
+                        for name, w, h, x, y, primary in cached['monitors']]
+        else:
+            profiling.count("monitors.miss")
+            with profiling.phase("get_screen_resolution"):
+                monitors = utils.get_monitors()
+            self.state['monitors'] = {
+                'fingerprint': fingerprint, 'detected': time.time(),
+                'monitors': [[m.name, m.resolution.w, m.resolution.h, m.x,
+                              m.y, m.primary] for m in monitors]}
+        self.monitors = (fingerprint, monitors)
+        return monitors
+
+    def get_resolutions(self) -> List[Resolution]:
+        # Resolutions to download wallpapers in, the one of the primary
+        # monitor first. Wallpapers are selected by the first one.
         resolution = self.config_get("resolution")
         if resolution == "default":
-            return utils.get_screen_resolution()
+            resolutions: List[Resolution] = []
+            for monitor in self.get_monitors():
+                if monitor.resolution not in resolutions:
+                    resolutions.append(monitor.resolution)
+            return resolutions
         w, h = resolution.split('x')[0:2]
-        return Resolution(w, h)
+        return [Resolution(w, h)]
 
-    def get_wallpaper_cache_path(self, id: WPID, image_url: str) -> str:
-        return "{}/{}.{}".format(
+    def get_resolution(self) -> Resolution:
+        return self.get_resolutions()[0]
+
+    def get_wallpaper_cache_path(self, id: WPID, image_url: str,
+                                 resolution: Optional[Resolution]=None) -> str:
+        # Images for monitors other than the primary one are stored with
+        # their resolution appended to the name.
+        suffix = ""
+        if resolution is not None and resolution != self.get_resolution():
+            suffix = "@{}x{}".format(resolution.w, resolution.h)
+        return "{}/{}{}.{}".format(
             self.config_get_filesystem_path("cache-dir"),
-            id, image_url.split('.')[-1])
+            id, suffix, image_url.split('.')[-1])
+
+    def download_image(self, source: str, target: str,
+                       on_chunk: Optional[Callable[[int], None]]=None) -> bool:
+        with profiling.phase("download_image", url=source):
+            downloaded = wpa.download_image(source, target, on_chunk)
+        if not downloaded:
+            print("Failed to download {}".format(source))
+            return False
+        self.image_cache.add(target)
+        return True
 
-    def download_image(self, source, target):
-        os.makedirs(os.path.dirname(target), exist_ok=True)
-        s = requests.Session()
-        image = s.get(source, stream=True)
-        with open(target, 'wb') as out_file:
-            shutil.copyfileobj(image.raw, out_file)
+    def prune_image_cache(self) -> Tuple[int, int]:
+        # The current wallpaper, history, liked wallpapers and the prefetched
+        # ones are kept regardless of the budget.
+        protected: Set[WPID] = set(self.store.history())
+        protected.update(self.store.marked("liked"))
+        protected.update(WPID(e['id'])
+                         for e in self.get_prefetch_queue().entries())
+        if self.get_current():
+            protected.add(self.get_current())
+        return self.image_cache.prune(protected)
 
     def get_current(self) -> WPID:
         # TODO: Maybe we could avoid storing the wallpaper name in the
         # state file and fetch it from DE config instead?
         return self.state.get("current", None)
 
+    def get_backend(self):
+        # Kept for the lifetime of the process, so that the daemon sets
+        # wallpapers through the same connection every time.
+        name = self.config_get("backend")
+        if self.backend is None or self.backend_name != name:
+            self.backend = backends.get_backend(
+                name, os.path.expanduser(self.config_get("backend-file")))
+            self.backend_name = name
+        return self.backend
+
+    def get_image_url(self, wpid: WPID, resolution: Resolution,
+                      scope: Optional[WPScope]=None) -> Optional[str]:
+        # scope is the one wpid was listed in, the current one by default.
+        known, image_url = self.image_url_cache.lookup(wpid, resolution)
+        if known:
+            return image_url
+        if scope is None:
+            scope = WPScope(self.config_get("scope"))
+        if (scope not in ["liked", "disliked"] and
+                self.get_scope_index(scope).lists(wpid, resolution)):
+            return wpa.listed_image_url(wpid, resolution)
+        known, image_url = wpa.resolve_image_url(wpid, resolution)
+        if known:
+            self.image_url_cache.store(wpid, resolution, image_url)
+        return image_url
+
+    def fetch_image(self, wpid: WPID, resolution: Resolution,
+                    image_url: str) -> Optional[str]:
+        # Makes sure the image is in the cache directory, returns the URL it
+        # was found at. Cached or guessed URLs which fail to download are
+        # resolved again before giving up.
+        target_file = self.get_wallpaper_cache_path(wpid, image_url,
+                                                    resolution)
+        cached = os.path.exists(target_file)
+        profiling.count("image-cache.hit" if cached else "image-cache.miss")
+        if not cached and not self.download_image(image_url, target_file):
+            known, fresh_url = wpa.resolve_image_url(wpid, resolution)
+            if known:
+                self.image_url_cache.store(wpid, resolution, fresh_url)
+            if not fresh_url or fresh_url == image_url:
+                return None
+            image_url = fresh_url
+            target_file = self.get_wallpaper_cache_path(wpid, image_url,
+                                                        resolution)
+            if not self.download_image(image_url, target_file):
+                return None
+        self.image_url_cache.store(wpid, resolution, image_url)
+        return image_url
+
+    def fetch_image_in(self, wpid: WPID,
+                       resolution: Resolution) -> Optional[str]:
+        # Returns the path of the image downloaded for a secondary monitor.
+        image_url = self.get_image_url(wpid, resolution)
+        if image_url:
+            image_url = self.fetch_image(wpid, resolution, image_url)
+        if not image_url:
+            return None
+        return self.get_wallpaper_cache_path(wpid, image_url, resolution)
+
     # Returns true iff the wallpaper was actually changed
-    def switch_to_wallpaper(self, id: WPID, dry_run: bool=False) -> bool:
-        resolution = self.get_resolution()
-        image_url = wpa.get_image_url(id, resolution)
+    def switch_to_wallpaper(self, id: WPID, dry_run: bool=False,
+                            image_url: Optional[str]=None) -> bool:
+        resolutions = self.get_resolutions()
+        resolution = resolutions[0]
+        if image_url is None:
+            image_url = self.get_image_url(id, resolution)
         if not image_url:
             print("Wallpaper {} not found in requested resolution ({}x{}).".
                   format(id, resolution.w, resolution.h))
@@ -210,28 +502,121 @@ class WPCraft:
         print("Switching to wallpaper: {}{}".format(
             (id), " (dry run)" if dry_run else ""))
 
+        # Images for other monitors are downloaded alongside the main one.
+        # Those which are not available fall back to the main image.
+        others: Dict[Resolution, Optional[str]] = {}
+        if len(resolutions) > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(
+                    len(resolutions) - 1) as executor:
+                futures = {r: executor.submit(self.fetch_image_in, id, r)
+                           for r in resolutions[1:]}
+                image_url = self.fetch_image(id, resolution, image_url)
+                others = {r: f.result() for r, f in futures.items()}
+        else:
+            image_url = self.fetch_image(id, resolution, image_url)
+        if not image_url:
+            return False
         target_file = self.get_wallpaper_cache_path(id, image_url)
-        if not os.path.exists(target_file):
-            self.download_image(image_url, target_file)
+        self.image_cache.touch(target_file)
 
         if dry_run:
             return True  # Pretend the change was performed.
 
-        # TODO: Detect desktop environment
-        utils.set_wallpaper_gnome3(target_file)
+        per_monitor = None
+        if others:
+            per_monitor = [(m, others.get(m.resolution) or target_file)
+                           for m in self.get_monitors()]
+        with profiling.phase("set_wallpaper"):
+            self.get_backend().set_wallpaper(target_file, per_monitor)
 
         # Record the change in state file
         previous = self.get_current()
-        history = self.state.get("history", [])
         if previous:
-            history_size = self.config_get('history-size')
-            self.state["history"] = ([previous] + history)[:history_size]
+            self.store.push_history(previous, self.config_get('history-size'))
         self.state["current"] = str(id)
         self.state["current-url"] = image_url
         self.state["last-changed"] = time.time()
 
         return True
 
+    def switch_to_random(self, wpids: List[WPID],
+                         dry_run: bool=False) -> bool:
+        # TODO: Maybe avoid selecting the same wp in a row if there are not too
+        # many to choose from.
+        tried: Set[WPID] = set()
+        available = len(set(wpids))
+        while len(tried) < available:
+            newwpid = random.choice(wpids)
+            if newwpid in tried:
+                continue
+            tried.add(newwpid)
+            if self.switch_to_wallpaper(newwpid, dry_run=dry_run):
+                return True
+        return False
+
+    def get_prefetch_queue(self) -> PrefetchQueue:
+        resolution = self.get_resolution()
+        key = "{} {}x{} {}".format(self.config_get("scope"), resolution.w,
+                                   resolution.h, self.config_get("min-score"))
+        return PrefetchQueue(
+            os.path.join(self.config_get_filesystem_path("cache-dir"),
+                         "prefetch.json"), key)
+
+    def switch_to_prefetched(self) -> bool:
+        queue = self.get_prefetch_queue()
+        while True:
+            entry = queue.pop()
+            if entry is None:
+                profiling.count("prefetch.miss")
+                return False
+            profiling.count("prefetch.hit")
+            wpid = WPID(entry['id'])
+            if self.is_disliked(wpid) or wpid == self.get_current():
+                continue
+            if self.switch_to_wallpaper(wpid, image_url=entry['url']):
+                return True
+
+    def start_prefetch(self) -> None:
+        # Prefetching happens in a separate process, so that the current
+        # command can exit right away.
+        if not self.config_get("prefetch-count"):
+            return
+        if self.prefetch_in_process:
+            self.prefetch_requested = True
+            return
+        import subprocess
+        subprocess.Popen([sys.executable, "-m", "wpcraft.wpcraft", "prefetch"],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def prefetch(self) -> None:
+        count = self.config_get("prefetch-count")
+        queue = self.get_prefetch_queue()
+        scope = WPScope(self.config_get("scope"))
+        resolution = self.get_resolution()
+        if self.should_sample(scope):
+            batches = self.iter_sampled_wpids(scope)
+        else:
+            batches = iter([self.get_wpids(scope)])
+        for wpids in batches:
+            for wpid in random.sample(wpids, len(wpids)):
+                ready = queue.entries()
+                if len(ready) >= count:
+                    return
+                if (wpid == self.get_current() or self.is_disliked(wpid) or
+                        any(e['id'] == wpid for e in ready)):
+                    continue
+                image_url = self.get_image_url(wpid, resolution)
+                if image_url:
+                    image_url = self.fetch_image(wpid, resolution, image_url)
+                if not image_url:
+                    continue
+                queue.push({'id': wpid, 'url': image_url,
+                            'path': self.get_wallpaper_cache_path(
+                                wpid, image_url)})
+                self.prune_image_cache()
+
     def get_current_scope_name(self) -> str:
         scope = self.config_get("scope").split("/", 1)
         return {
@@ -244,45 +629,91 @@ class WPCraft:
             param=(scope[1] if len(scope) >= 2 else None))
 
     def is_liked(self, wpid: WPID) -> bool:
-        return wpid in self.preferences.get("liked", [])
+        return self.store.is_marked(wpid, "liked")
 
     def is_disliked(self, wpid: WPID) -> bool:
-        return wpid in self.preferences.get("disliked", [])
+        return self.store.is_marked(wpid, "disliked")
 
     def mark(self, wpid: WPID, set_name: str, val: bool=True) -> None:
-        wpset: Set[WPID] = set(self.preferences.get(set_name, []))
-        if val and wpid not in wpset:
-            wpset.add(wpid)
-            # Update tag votes
-            for t in self.get_tags(wpid):
-                self.vote_tag(t, SET_VOTES.get(set_name, 0))
-        elif not val and wpid in wpset:
-            wpset.remove(wpid)
+        if self.store.is_marked(wpid, set_name) == val:
+            return
+        votes = self.get_tag_votes_for(wpid, set_name)
+        # Tags are looked up first, so that no transaction is held open
+        # while waiting for the network.
+        tags = self.get_tags(wpid) if votes is not None else []
+        change = SET_VOTES.get(set_name, 0) * (1 if val else -1)
+        with self.store.transaction():
+            self.store.set_marked(wpid, set_name, val)
             # Update tag votes
-            for t in self.get_tags(wpid):
-                self.vote_tag(t, -1 * SET_VOTES.get(set_name, 0))
-        self.preferences[set_name] = list(wpset)
+            for t in tags:
+                self.vote_tag(t, change, votes)
 
     def get_tags(self, wpid: WPID) -> List[str]:
-        wpdata = wpa.get_wpdata(wpid)
+        wpdata = self.get_wpdata(wpid)
         return wpdata.tags if wpdata else []
 
-    def vote_tag(self, tag: str, change: int) -> None:
+    def get_tag_votes_for(self, wpid: WPID, set_name: str) -> Optional[str]:
+        # Returns the kind of vote totals which a change of wpid's membership
+        # in set_name should be applied to. While a recomputation is in
+        # progress, only wallpapers it has already visited are accounted for
+        # in the partial totals; the rest will be picked up when it reaches
+        # them.
+        if not self.tag_votes_pending():
+            return 'current'
+        if (self.store.get_meta('votes-checkpoint') and
+                self.store.is_tag_votes_done(wpid, set_name)):
+            return 'checkpoint'
+        return None
+
+    def vote_tag(self, tag: str, change: int, votes: str='current') -> None:
         if change == 0:
             return
-        v = self.preferences['votes'].get(tag, 0)
-        self.preferences['votes'][tag] = v + change
+        self.store.add_tag_vote(tag, change, votes)
+
+    def tag_votes_pending(self) -> bool:
+        # Recomputing the votes needs metadata for every marked wallpaper,
+        # which may take a long while, so it is left for `recompute_tags` (or
+        # the first command that needs the votes) instead of blocking
+        # startup.
+        return self.store.get_meta('votes-pending', False)
 
-    def recompute_all_tags(self):
+    def recompute_all_tags(self, restart: bool=False) -> None:
         # This function disregards current tag votes and initializes them from
-        # liked and disliked sets.
-        self.preferences['votes'] = {}
-        for wpid in self.preferences.get("liked", []):
-            for t in self.get_tags(wpid):
-                self.vote_tag(t, SET_VOTES['liked'])
-        for wpid in self.preferences.get("disliked", []):
-            for t in self.get_tags(wpid):
-                self.vote_tag(t, SET_VOTES['disliked'])
+        # liked and disliked sets. Metadata is fetched concurrently, in
+        # batches; partial totals are checkpointed to the store after every
+        # batch, so that an interrupted run resumes where it stopped.
+        if restart or not self.store.get_meta('votes-checkpoint'):
+            self.store.start_tag_votes_checkpoint()
+
+        done = self.store.tag_votes_done()
+        todo = [(wpid, set_name)
+                for set_name in SET_VOTES
+                for wpid in self.store.marked(set_name)
+                if (set_name, wpid) not in done]
+        total = sum(self.store.count_marked(s) for s in SET_VOTES)
+
+        import concurrent.futures
+        msg = "\rRecomputing tag votes: "
+        with concurrent.futures.ThreadPoolExecutor(
+                TAG_RECOMPUTE_WORKERS) as executor:
+            for i in range(0, len(todo), TAG_RECOMPUTE_BATCH):
+                batch = todo[i:i + TAG_RECOMPUTE_BATCH]
+                if asyncaccess.available():
+                    self.prefetch_wpdata([wpid for wpid, _ in batch])
+                tags = executor.map(lambda q: self.get_tags(q[0]), batch)
+                tags = list(tags)
+                with self.store.transaction():
+                    for (wpid, set_name), wptags in zip(batch, tags):
+                        for t in wptags:
+                            self.vote_tag(t, SET_VOTES[set_name],
+                                          'checkpoint')
+                        self.store.set_tag_votes_done(wpid, set_name)
+                self.wpdata_cache.save()
+                done = total - len(todo) + i + len(batch)
+                print((msg + "{}/{}...").format(done, total), end='')
+        print(msg + "done." + " " * 16)
+
+        self.store.finish_tag_votes_checkpoint()
 
     def show_details(self, wpid: WPID) -> None:
         wpdata = self.get_wpdata(wpid)
@@ -310,99 +741,108 @@ class WPCraft:
 
     def cmd_next(self, args) -> None:
         # Increment counter
-        counter = self.state.get("counter", 0)
-        counter = counter + 1
-        self.state["counter"] = counter
-
-        wpids = self.get_wpids()
-        if len(wpids) is 0:
-            print("No wallpapers {} were found.".format(
-                self.get_current_scope_name()))
+        with self.store.transaction():
+            counter = self.state.get("counter", 0)
+            counter = counter + 1
+            self.state["counter"] = counter
+            self.store.touch_scope(WPScope(self.config_get("scope")))
+
+        # Wallpapers downloaded in the background after the previous switch
+        # are used first.
+        changed = not args.dry_run and self.switch_to_prefetched()
+        if not changed:
+            with profiling.phase("select"):
+                changed = self.switch_to_selected(dry_run=args.dry_run)
+        if not changed:
             return
-        # TODO: Maybe avoid selecting the same wp in a row if there are not too
-        # many to choose from.
-        changed = False
-        while not changed:
-            newwpid = random.choice(wpids)
-            changed = self.switch_to_wallpaper(newwpid, dry_run=args.dry_run)
+
+        if not args.dry_run:
+            with profiling.phase("prune_image_cache"):
+                self.prune_image_cache()
+            self.start_prefetch()
 
         current = self.get_current()
-        self.show_details(current)
+        if current:
+            self.show_details(current)
+
+    def switch_to_selected(self, dry_run: bool=False) -> bool:
+        # A wallpaper is picked from the first batch of IDs that becomes
+        # available. If the scope has to be crawled first, the rest of the
+        # crawl only completes the index. Sampled pages are only fetched
+        # until one of them yields a wallpaper.
+        scope = WPScope(self.config_get("scope"))
+        sample = self.should_sample(scope)
+        batches = (self.iter_sampled_wpids(scope) if sample
+                   else self.iter_wpids(scope))
+        changed = False
+        found = 0
+        for wpids in batches:
+            found += len(wpids)
+            if not changed:
+                changed = self.switch_to_random(wpids, dry_run=dry_run)
+            if changed and sample:
+                break
+        if found == 0:
+            print("No wallpapers {} were found.".format(
+                self.get_current_scope_name()))
+        elif not changed:
+            print("None of the wallpapers {} are available.".format(
+                self.get_current_scope_name()))
+        return changed
 
     def find_dbus_address(self) -> str:
-                # Find a PID of a process running inside desktop session
-        pidlist = [int(s.strip()) for s in subprocess.check_output(
-            ["ps", "-o", "pid=", "U", str(os.getuid())]
-        ).decode('ascii').splitlines() if s != '']
-
-        # Look for a process that has DBUS_SESSION_BUS_ADDRESS env var set.
-        KEY = "DBUS_SESSION_BUS_ADDRESS"
-        dbus_address = ""
-        for pid in pidlist:
-            try:
-                env = open('/proc/{}/environ'.format(pid)).read().split('\0')
-                cmd = open('/proc/{}/cmdline'.format(pid)).read().split('\0')
-            except (PermissionError, FileNotFoundError):
-                continue
-            values = [e[len(KEY) + 1:] for e in env if e.startswith(KEY)]
-            if len(values) > 0:
-                if 'gnome-session' in cmd:
-                    # Okay, we found gnome session. This is the preferred
-                    # result. Return immediately.
-                    print("gnome-session found.")
-                    return values[0]
-                # Save this result for later.
-                dbus_address = values[0]
-
-        return dbus_address
+        # The address found last time is reused for as long as the session
+        # it was found in is running; the user's processes are only scanned
+        # when it is not.
+        cached = self.state.get('dbus-session')
+        if cached and utils.dbus_session_alive(cached['address'],
+                                               cached['pid']):
+            profiling.count('dbus-session.hit')
+            return cached['address']
+        profiling.count('dbus-session.miss')
+
+        found = utils.find_dbus_session()
+        if found is None:
+            return ""
+        address, pid = found
+        self.state['dbus-session'] = {'address': address, 'pid': pid}
+        return address
+
+    def join_session(self) -> str:
+        # Sets up the environment of a process started outside of the
+        # desktop session (by cron, or a service manager) like that of the
+        # session: the DBus address, and the variables telling which desktop
+        # is running, so that the right backend is detected. Returns the
+        # DBus address.
+        address = (os.getenv("DBUS_SESSION_BUS_ADDRESS") or
+                   self.find_dbus_address())
+        if address:
+            os.environ["DBUS_SESSION_BUS_ADDRESS"] = address
+        session = self.state.get('dbus-session')
+        if session and not any(os.getenv(v)
+                               for v in backends.DESKTOP_VARIABLES):
+            os.environ.update(utils.session_environ(
+                session['pid'], backends.DESKTOP_VARIABLES))
+        return address
 
     def cmd_next_cron(self, args) -> None:
         # cron rules use this command instead of next. This is because some
         # extra variables need to be added to the environment.
 
-        # Determine whether the time is right to switch the wallpaper.
-        last_changed = datetime.datetime.utcfromtimestamp(
-            int(self.state.get('last-changed', 0)))
-        delta = datetime.datetime.utcnow() - last_changed
-
-        if 'auto' not in self.state or not self.state['auto']:
-            print("Auto mode is not enabled")
-            return
-        n, per = self.state['auto'].split(' ')
-        n = int(n)
-        if per == 'minutes':
-            target_delta = datetime.timedelta(minutes=n)
-        elif per == 'hours':
-            target_delta = datetime.timedelta(hours=n)
-        elif per == 'days':
-            target_delta = datetime.timedelta(days=n)
-        else:
-            return
-
-        print("Time since last switch: {}".format(delta))
-        print("Configured time between automatic switches: {}".format(
-            target_delta))
-
-        # Account for the time it might have taken the last cron change to
-        # download and set the wallpaper. Otherwise we would fall for
-        # discretization error and switch wallpapers every n+1 minutes instead
-        # of n.
-        delta += datetime.timedelta(seconds=10)
-
-        if delta < target_delta:
-            print("Skipping, not enough time has elapsed since last switch.")
+        # Determine whether the time is right to switch the wallpaper, unless
+        # main() already did.
+        if not getattr(args, 'due', False) and not auto_switch_due(self.state):
             return
 
-        dbus_address = self.find_dbus_address()
+        with profiling.phase("find_dbus_address"):
+            dbus_address = self.join_session()
 
         print("Using dbus address: " + dbus_address)
-        # Now, let's copy that value for ourselves.
-        os.environ["DBUS_SESSION_BUS_ADDRESS"] = dbus_address
         # Continue as normal 'next'.
         self.cmd_next(args)
 
     def cmd_prev(self, args) -> None:
-        history = self.state.get("history", [])
+        history = self.store.history()
         if len(history) is 0:
             print("No previous wallpaper")
             return
@@ -430,19 +870,157 @@ class WPCraft:
 
         print("{} wallpapers match these criteria.".format(len(wpids)))
 
+        if filtered_scope:
+            index = self.get_scope_index(WPScope(self.config_get("scope")))
+            print("Wallpapers by user score: {}".format(", ".join(
+                "{}+: {}".format(t, index.count(t))
+                for t in STATUS_SCORE_THRESHOLDS)))
+
         if self.state.get("auto", None):
             print("Automatically switching every {}.".format(
                 self.state["auto"]))
 
     def cmd_update(self, args) -> None:
-        idlist = self.get_wpids(clear_cache=True)
+        if getattr(args, 'all', False):
+            self.update_all_scopes(full=args.full)
+            return
+        if getattr(args, 'full', False):
+            idlist = self.get_wpids(clear_cache=True)
+        else:
+            idlist = self.get_wpids(incremental=True)
 
         print("Found {} wallpapers {}".format(
             len(idlist), self.get_current_scope_name()))
 
+    def cmd_mirror(self, args) -> None:
+        # Downloads every wallpaper of a scope into the image cache, e.g. to
+        # set up machines which should not need to download anything later.
+        scope = WPScope(args.scope or self.config_get("scope"))
+        resolution = self.get_resolution()
+        wpids = self.get_wpids(scope)
+        print("Mirroring {} wallpapers from '{}' in {}x{}.".format(
+            len(wpids), scope, resolution.w, resolution.h))
+
+        bandwidth = None
+        if args.max_rate:
+            rate = args.max_rate * 1024
+            bandwidth = wpa.TokenBucket(rate, rate)
+
+        def resolve(wpid: WPID) -> Optional[Tuple[str, str]]:
+            image_url = self.get_image_url(wpid, resolution, scope)
+            if not image_url:
+                return None
+            return image_url, self.get_wallpaper_cache_path(wpid, image_url)
+
+        def download(url: str, path: str,
+                     on_chunk: Callable[[int], None]) -> bool:
+            def chunk(n: int) -> None:
+                on_chunk(n)
+                if bandwidth:
+                    bandwidth.acquire(n)
+            return self.download_image(url, path, chunk)
+
+        # Loaded before the workers start, rather than by all of them at once.
+        self.image_url_cache.load()
+        max_bytes = (int(args.max_mb * 1024 * 1024)
+                     if args.max_mb is not None else None)
+        progress = mirror.Mirror(
+            resolve, download, resolvers=args.jobs, downloaders=args.jobs,
+            max_bytes=max_bytes).run(wpids)
+        print("{} downloaded, {} already present, {} not available in this "
+              "resolution, {} failed.".format(
+                  progress.done, progress.present, progress.unavailable,
+                  progress.failed))
+        if progress.over_budget():
+            print("Stopped after downloading {} MB.".format(args.max_mb))
+
+    def update_all_scopes(self, full: bool=False) -> None:
+        # Refreshes the index of every scope wpcraft knows of, so that
+        # switching scopes finds an index ready. Several scopes are updated
+        # at once, the stalest of the recently used ones first.
+        now = time.time()
+        current = WPScope(self.config_get("scope"))
+        scopes = {scope: update_priority(updated, used, now)
+                  for scope, updated, used in self.store.known_scopes()}
+        # The current scope is in use right now.
+        index = self.get_scope_index(current)
+        scopes[current] = update_priority(
+            index.updated if index.exists() else 0.0, now, now)
+        order = sorted((s for s in scopes if s not in ["liked", "disliked"]),
+                       key=lambda s: -scopes[s])
+        if not order:
+            print("No scopes to update.")
+            return
+        resolution = self.get_resolution()
+        print("Updating {} scopes in {}x{}.".format(
+            len(order), resolution.w, resolution.h))
+
+        import shutil
+        import threading
+        import concurrent.futures
+        lock = threading.Lock()
+        # Progress of the scopes being updated, shown on a single line.
+        running: Dict[WPScope, str] = {}
+
+        def show(done: Optional[str]=None) -> None:
+            width = shutil.get_terminal_size().columns - 1
+            line = " | ".join("{}: {}".format(s, p)
+                              for s, p in running.items())
+            if done:
+                print("\r" + done.ljust(width))
+            print("\r" + line.ljust(width)[:width], end='', flush=True)
+
+        def update(scope: WPScope) -> None:
+            def progress(n: int, total: Optional[int]) -> None:
+                with lock:
+                    running[scope] = ("{:.0f}%".format(100.0 * n / total)
+                                      if total else "page {}".format(n + 1))
+                    show()
+            with lock:
+                running[scope] = "starting"
+                show()
+            # Each thread works on its own index object.
+            index = ScopeIndex(self.store, scope)
+            try:
+                new = None
+                if (not full and index.exists() and
+                        index.fetched_in(resolution)):
+                    new = wpa.get_new_wpid_scores(scope, resolution,
+                                                  index.known(),
+                                                  progress=progress)
+                if new is not None:
+                    index.add_new(new)
+                    result = "{} new wallpapers".format(len(new))
+                else:
+                    entries = wpa.get_wpid_scores(scope, resolution,
+                                                  progress=progress)
+                    index.replace(entries, resolution)
+                    result = "{} wallpapers".format(len(entries))
+            except Exception as e:
+                result = "failed ({})".format(e)
+            with lock:
+                del running[scope]
+                show("{}: {}".format(scope, result))
+
+        with wpa.shared_pages():
+            with concurrent.futures.ThreadPoolExecutor(
+                    UPDATE_ALL_WORKERS) as executor:
+                # Submitted in order of priority, and started in that order.
+                list(executor.map(update, order))
+        print("\r" + " " * (shutil.get_terminal_size().columns - 1) + "\r",
+              end='')
+        print("Updated {} scopes.".format(len(order)))
+        self.scope_indexes = {}
+
+    def use_scope(self, scope: str) -> None:
+        # Scopes chosen with `use` and the ones switched in by `next` count
+        # as used for `update --all`; merely looking at them does not.
+        self.config["scope"] = scope
+        self.store.touch_scope(WPScope(scope))
+
     def cmd_use_tag(self, args) -> None:
         # TODO: Verify whether this tag exists
-        self.config["scope"] = "tag/{}".format(args.tag.lower())
+        self.use_scope("tag/{}".format(args.tag.lower()))
 
         idlist = self.get_wpids()
         print("Found {} wallpapers {}".format(
@@ -450,28 +1028,28 @@ class WPCraft:
 
     def cmd_use_catalog(self, args) -> None:
         # TODO: Verify whether this catalog exists
-        self.config["scope"] = "catalog/{}".format(args.catalog.lower())
+        self.use_scope("catalog/{}".format(args.catalog.lower()))
 
         idlist = self.get_wpids()
         print("Found {} wallpapers {}".format(
             len(idlist), self.get_current_scope_name()))
 
     def cmd_use_search(self, args) -> None:
-        self.config["scope"] = "search/{}".format(args.search.lower())
+        self.use_scope("search/{}".format(args.search.lower()))
 
         idlist = self.get_wpids()
         print("Found {} wallpapers {}".format(
             len(idlist), self.get_current_scope_name()))
 
     def cmd_use_liked(self, args) -> None:
-        self.config["scope"] = "liked"
+        self.use_scope("liked")
 
         idlist = self.get_wpids()
         print("Found {} wallpapers {}".format(
             len(idlist), self.get_current_scope_name()))
 
     def cmd_use_disliked(self, args) -> None:
-        self.config["scope"] = "disliked"
+        self.use_scope("disliked")
 
         idlist = self.get_wpids()
         print("Found {} wallpapers {}".format(
@@ -482,21 +1060,21 @@ class WPCraft:
         self.show_details(self.get_current())
 
     def cmd_show_liked(self, args) -> None:
-        liked = self.preferences.get("liked", [])
+        liked = self.store.marked("liked")
         if len(liked) is 0:
             print("No liked wallpapers")
         else:
             print("\n".join(liked))
 
     def cmd_show_disliked(self, args) -> None:
-        disliked = self.preferences.get("disliked", [])
+        disliked = self.store.marked("disliked")
         if len(disliked) is 0:
             print("No disliked wallpapers")
         else:
             print("\n".join(disliked))
 
     def cmd_show_history(self, args) -> None:
-        history = self.state.get("history", [])
+        history = self.store.history()
         if len(history) is 0:
             print("History is empty")
         else:
@@ -504,8 +1082,10 @@ class WPCraft:
 
     def cmd_show_tags(self, args) -> None:
         TAGS_MAX = 15
+        if self.tag_votes_pending():
+            self.recompute_all_tags()
         print("You seem to like these tags the most:")
-        votes = self.preferences.get("votes", {})
+        votes = self.store.tag_votes()
         result = sorted(votes.items(), key=lambda q: -q[1])
         if len(result) is 0:
             print("No tag preferences to display, mark more wallpapers as "
@@ -516,6 +1096,12 @@ class WPCraft:
 
         print("\n".join("{}: {}".format(t, v) for t, v in result))
 
+    def cmd_recompute_tags(self, args) -> None:
+        self.recompute_all_tags(restart=args.restart)
+        print("Tag votes computed from {} liked and {} disliked wallpapers."
+              .format(self.store.count_marked("liked"),
+                      self.store.count_marked("disliked")))
+
     def cmd_like(self, args) -> None:
         current = self.get_current()
 
@@ -551,6 +1137,99 @@ class WPCraft:
         self.mark(wpid, "disliked", False)
         print("Removed like/dislike mark for current wallpaper.")
 
+    def cmd_prefetch(self, args) -> None:
+        # Runs in the background after each switch. Only one prefetching
+        # process is needed at a time.
+        cache_dir = self.config_get_filesystem_path("cache-dir")
+        os.makedirs(cache_dir, exist_ok=True)
+        lock_path = os.path.join(cache_dir, "prefetch-worker.lock")
+        with open(lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            try:
+                self.prefetch()
+            finally:
+                self.wpdata_cache.save()
+                self.image_url_cache.save()
+
+    def cmd_daemon(self, args) -> None:
+        # Stays running, switching wallpapers when automatic switching says
+        # so, and serving DAEMON_COMMANDS for the command line. The HTTP
+        # session, caches and the DBus address are kept between switches.
+        self.join_session()
+        self.prefetch_in_process = True
+        self.get_backend()
+        self.parser = make_parser()
+        path = daemon_socket_path(self.config)
+        print("Listening on {}".format(path))
+        daemon.Daemon(path, self.handle_daemon_command,
+                      self.daemon_tick).serve_forever()
+
+    def handle_daemon_command(self, argv: List[str]) -> Tuple[int, str]:
+        output = io.StringIO()
+        status = 0
+        with redirect_stdout(output), redirect_stderr(output):
+            try:
+                args = self.parser.parse_args(argv)
+                if args.command not in DAEMON_COMMANDS:
+                    exit("Error: '{}' is not served by the daemon.".format(
+                        args.command))
+                args.program = "wpcraft"
+                args.due = None
+                self.reload_config()
+                args.func(self, args)
+                self.save()
+            except SystemExit as e:
+                if isinstance(e.code, str):
+                    print(e.code)
+                    status = 1
+                else:
+                    status = e.code or 0
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        return status, output.getvalue()
+
+    def daemon_tick(self) -> Optional[float]:
+        # Switches the wallpaper if it is time to, and prefetches if asked
+        # to. Returns the number of seconds until the next switch.
+        try:
+            self.reload_config()
+            wait = None
+            interval = auto_switch_interval(self.state.get('auto'))
+            if interval is not None:
+                wait = (self.state.get('last-changed', 0) +
+                        interval.total_seconds() - time.time())
+                if wait <= 0:
+                    self.cmd_next(argparse_namespace(dry_run=False))
+                    self.save()
+                    wait = interval.total_seconds()
+            if self.prefetch_requested:
+                self.prefetch_requested = False
+                self.cmd_prefetch(None)
+            return wait
+        except Exception:
+            traceback.print_exc()
+            return DAEMON_RETRY_DELAY
+
+    def cmd_cache_stats(self, args) -> None:
+        stats = self.image_cache.stats()
+        print("Cached images: {} of at most {}".format(
+            stats['files'], self.config_get("cache-max-files")))
+        print("Cache size: {:.1f} MB of at most {} MB".format(
+            stats['bytes'] / 1024 / 1024, self.config_get("cache-max-mb")))
+        if stats['files']:
+            print("Least recently used image was last used on {}.".format(
+                datetime.datetime.fromtimestamp(stats['oldest'])
+                .strftime("%Y-%m-%d %H:%M")))
+
+    def cmd_cache_prune(self, args) -> None:
+        removed, freed = self.prune_image_cache()
+        print("Removed {} cached images, freed {:.1f} MB.".format(
+            removed, freed / 1024 / 1024))
+
     def cmd_auto_disable(self, args) -> None:
         with user_crontab() as cron:
             cron.remove_all(comment=CRONTAB_COMMENT)
@@ -577,11 +1256,105 @@ class WPCraft:
         self.cron_enable()
 
     def cmd_min_score(self, args) -> None:
+        # Scope indexes hold scores of all wallpapers, so there is no need to
+        # download anything again.
         self.config['min-score'] = args.min_score
-        self.invalidate_scope_cache()
-        self.cmd_update(args)
+        idlist = self.get_wpids()
+        print("Found {} wallpapers {}".format(
+            len(idlist), self.get_current_scope_name()))
 
-def main() -> None:
+def update_priority(updated: float, used: float, now: float) -> float:
+    # Scopes with higher priority are updated first by `update --all`.
+    age = now - updated if updated else UPDATE_ALL_UNINDEXED_AGE
+    weight = 0.5 ** ((now - used) / UPDATE_ALL_USAGE_HALF_LIFE)
+    return age * max(weight, UPDATE_ALL_MIN_WEIGHT)
+
+
+def auto_switch_interval(auto: Optional[str]) -> Optional[datetime.timedelta]:
+    # Parses the 'auto' state setting, e.g. "5 minutes".
+    if not auto:
+        return None
+    n, per = auto.split(' ')
+    if per not in ['minutes', 'hours', 'days']:
+        return None
+    return datetime.timedelta(**{per: int(n)})
+
+
+def auto_switch_due(state) -> bool:
+    # Whether automatic switching is enabled and enough time has passed
+    # since the last switch.
+    last_changed = datetime.datetime.utcfromtimestamp(
+        int(state.get('last-changed', 0)))
+    delta = datetime.datetime.utcnow() - last_changed
+
+    if not state.get('auto'):
+        print("Auto mode is not enabled")
+        return False
+    target_delta = auto_switch_interval(state['auto'])
+    if target_delta is None:
+        return False
+
+    print("Time since last switch: {}".format(delta))
+    print("Configured time between automatic switches: {}".format(
+        target_delta))
+
+    # Account for the time it might have taken the last cron change to
+    # download and set the wallpaper. Otherwise we would fall for
+    # discretization error and switch wallpapers every n+1 minutes instead
+    # of n.
+    delta += datetime.timedelta(seconds=10)
+
+    if delta < target_delta:
+        print("Skipping, not enough time has elapsed since last switch.")
+        return False
+    return True
+
+
+def load_config_file(config_path: str) -> Optional[Dict[str, Any]]:
+    # Reads the config file without setting up WPCraft, for the few things
+    # main() needs to know before that.
+    try:
+        return json.load(open(os.path.expanduser(config_path), 'r'))
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        return None
+
+
+def daemon_socket_path(config: Dict[str, Any]) -> str:
+    path = config.get("daemon-socket")
+    if path:
+        return os.path.abspath(os.path.expanduser(path))
+    cache_dir = config.get("cache-dir", DEFAULT_CONFIG["cache-dir"])
+    return daemon.socket_path(os.path.abspath(os.path.expanduser(cache_dir)))
+
+
+def next_cron_due(config: Optional[Dict[str, Any]]) -> Optional[bool]:
+    # cron runs next_cron every minute, and most of the time there is
+    # nothing to do. This answers whether a switch is due reading as little
+    # as possible, without setting up WPCraft. Returns None if it can't tell
+    # (e.g. the store is yet to be created from legacy files).
+    if config is None:
+        return None
+    store_path = os.path.abspath(os.path.expanduser(
+        config.get("store-path", DEFAULT_CONFIG["store-path"])))
+    if not os.path.exists(store_path):
+        return None
+    store = Store(store_path)
+    try:
+        if not store.migrated():
+            return None
+        return auto_switch_due(store.state)
+    finally:
+        store.close()
+
+
+def argparse_namespace(**kwargs):
+    import argparse
+    return argparse.Namespace(**kwargs)
+
+
+def make_parser():
+    # Only imported past the next_cron fast path in main().
+    import argparse
     parser = argparse.ArgumentParser(
         prog="wpcraft",
         description="Browse wallpapercraft images from command-line.")
@@ -590,6 +1363,14 @@ def main() -> None:
 
     parser.add_argument('--dry-run', '-n', action="store_true",
                         help="Never change current wallpaper.")
+    parser.add_argument('--profile', action="store_true",
+                        help="Print a breakdown of where the time went.")
+    parser.add_argument('--profile-output', metavar='FILE',
+                        help="Write the profile to FILE, as a trace which "
+                        "chrome://tracing can open. Implies --profile.")
+    parser.add_argument('--no-daemon', action="store_true",
+                        help="Run the command here even if `wpcraft "
+                        "daemon` is running.")
 
     parser_status = subparsers.add_parser(
         'status', help="Display information about the current wallpaper.")
@@ -602,6 +1383,16 @@ def main() -> None:
         'next_cron')
     parser_next_cron.set_defaults(func=WPCraft.cmd_next_cron)
 
+    # Started in the background by `next`; it must not save state, config or
+    # preferences, since the foreground process may be modifying them.
+    parser_prefetch = subparsers.add_parser('prefetch')
+    parser_prefetch.set_defaults(func=WPCraft.cmd_prefetch, save=False)
+
+    parser_daemon = subparsers.add_parser(
+        'daemon', help="Keep running, switching wallpapers automatically "
+        "and serving commands from the command line faster.")
+    parser_daemon.set_defaults(func=WPCraft.cmd_daemon)
+
     parser_prev = subparsers.add_parser(
         'prev', help="Go back to the previous wallpaper.")
     parser_prev.set_defaults(func=WPCraft.cmd_prev)
@@ -609,6 +1400,31 @@ def main() -> None:
     parser_update = subparsers.add_parser(
         'update', help="Refresh the list of available wallpapers.")
     parser_update.set_defaults(func=WPCraft.cmd_update)
+    parser_update.add_argument(
+        '--full', action="store_true",
+        help="Download the whole list again instead of only new wallpapers.")
+    parser_update.add_argument(
+        '--all', action="store_true",
+        help="Update every catalog, tag or search used before, not only the "
+        "current one. Recently used ones are updated first.")
+
+    parser_mirror = subparsers.add_parser(
+        'mirror', help="Download all wallpapers of the current scope into "
+        "the cache, e.g. to prepare a machine for offline use. Run again to "
+        "resume an interrupted mirror.")
+    parser_mirror.set_defaults(func=WPCraft.cmd_mirror)
+    parser_mirror.add_argument(
+        '--scope', help="Mirror SCOPE (e.g. catalog/nature, tag/sunset or "
+        "liked) instead of the current one.")
+    parser_mirror.add_argument(
+        '--jobs', '-j', type=int, default=4,
+        help="Number of downloads at once (default: 4).")
+    parser_mirror.add_argument(
+        '--max-rate', type=float, metavar='KB',
+        help="Limit download speed to KB kilobytes per second.")
+    parser_mirror.add_argument(
+        '--max-mb', type=float, metavar='MB',
+        help="Stop after downloading MB megabytes.")
 
     parser_use = subparsers.add_parser(
         'use', help="Selects which wallpapers to use.")
@@ -677,6 +1493,27 @@ def main() -> None:
         'tags', help="Show summary of tags you liked with `wpcraft like`.")
     parser_show_tags.set_defaults(func=WPCraft.cmd_show_tags)
 
+    parser_recompute_tags = subparsers.add_parser(
+        'recompute_tags',
+        help="Recompute tag statistics from liked/disliked wallpapers.")
+    parser_recompute_tags.add_argument(
+        '--restart', action="store_true",
+        help="Discard progress of an interrupted recomputation.")
+    parser_recompute_tags.set_defaults(func=WPCraft.cmd_recompute_tags)
+
+    parser_cache = subparsers.add_parser(
+        'cache', help="Manage downloaded wallpaper images.")
+    cache_subparsers = parser_cache.add_subparsers(dest='cache')
+    cache_subparsers.required = True
+
+    parser_cache_stats = cache_subparsers.add_parser(
+        'stats', help="Show how much space cached images take.")
+    parser_cache_stats.set_defaults(func=WPCraft.cmd_cache_stats)
+
+    parser_cache_prune = cache_subparsers.add_parser(
+        'prune', help="Remove cached images exceeding the cache budget.")
+    parser_cache_prune.set_defaults(func=WPCraft.cmd_cache_prune)
+
     parser_auto = subparsers.add_parser(
         'auto', help="Automatically switch wallpapers every X hours/minutes.")
     auto_subparsers = parser_auto.add_subparsers(dest='auto')
@@ -708,15 +1545,54 @@ def main() -> None:
         "Set to '0' (default) to disable filtering.")
     parser_min_score.add_argument('min_score', metavar='X', type=float)
     parser_min_score.set_defaults(func=WPCraft.cmd_min_score)
+    return parser
+
 
-    args = parser.parse_args()
+def main() -> None:
+    config = None
+    due = None
+    if sys.argv[1:] == ['next_cron']:
+        config = load_config_file(CONFIG_FILE_PATH)
+        due = next_cron_due(config)
+        if due is False:
+            return
+        if daemon.is_running(daemon_socket_path(config or {})):
+            print("wpcraft daemon is running, leaving the switch to it.")
+            return
+
+    args = make_parser().parse_args()
     args.program = sys.argv[0]
+    args.due = due
+
+    if (args.command in DAEMON_COMMANDS and not args.no_daemon and
+            not args.profile and not args.profile_output):
+        config = load_config_file(CONFIG_FILE_PATH) or {}
+        result = daemon.send_command(daemon_socket_path(config),
+                                     sys.argv[1:])
+        if result is not None:
+            status, output = result
+            print(output, end='')
+            if status:
+                sys.exit(status)
+            return
+
+    if args.profile or args.profile_output:
+        profiling.enable()
+
+    with profiling.phase("startup"):
+        wpcraft = WPCraft(CONFIG_FILE_PATH)
 
-    wpcraft = WPCraft(CONFIG_FILE_PATH)
+    with profiling.phase(args.command):
+        args.func(wpcraft, args)
 
-    args.func(wpcraft, args)
+    if getattr(args, 'save', True):
+        with profiling.phase("save"):
+            wpcraft.save()
 
-    wpcraft.save()
+    if args.profile or args.profile_output:
+        profiling.profiler.report()
+    if args.profile_output:
+        profiling.profiler.write(args.profile_output)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,5 @@
 from .wpcraftaccess import (WPScope, WPID, WPData, get_image_url,
-                            get_wpids, get_wpdata)
+                            get_wpids, get_wpid_scores, get_wpdata)
 
-__all__ = ["WPScope", "WPID", "WPData", "get_wpids", "get_image_url",
-           "get_wpdata"]
+__all__ = ["WPScope", "WPID", "WPData", "get_wpids", "get_wpid_scores",
+           "get_image_url", "get_wpdata"]
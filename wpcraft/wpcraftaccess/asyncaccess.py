@@ -0,0 +1,181 @@
+import asyncio
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from wpcraft.types import WPScope, WPData, WPID, Resolution
+from wpcraft.profiling import profiling
+from wpcraft.wpcraftaccess import wpcraftaccess as wpa
+from wpcraft.wpcraftaccess.parsing import (PageEntries, parse_page_entries,
+                                           parse_wpdata, parse_npages,
+                                           parse_image_name)
+
+# aiohttp is optional. Without it, the thread-based functions from
+# wpcraftaccess are used instead.
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Upper bound on requests in flight at once. The rate limiter decides how
+# fast they actually go out, this only keeps memory use in check for huge
+# crawls.
+MAX_IN_FLIGHT = 1000
+# Size of the keep-alive connection pool.
+POOL_SIZE = 64
+REQUEST_TIMEOUT = 30
+
+
+def available() -> bool:
+    return aiohttp is not None
+
+
+class AsyncAccess:
+    """Asynchronous counterpart of the wpcraftaccess API.
+
+    Requests share the token buckets of wpcraftaccess, so the sync and async
+    layers never exceed the rate limits together. Must be used as an async
+    context manager, which owns the HTTP session and its connection pool.
+    """
+    def __init__(self, max_in_flight: int=MAX_IN_FLIGHT,
+                 pool_size: int=POOL_SIZE,
+                 pooled_parsing: bool=False) -> None:
+        self.max_in_flight = max_in_flight
+        self.pool_size = pool_size
+        # Whether responses are parsed in the wpcraftaccess process pool
+        # rather than on the event loop. Worth it for bulk operations only.
+        self.pooled_parsing = pooled_parsing
+        self.session: Any = None
+        self.in_flight: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> 'AsyncAccess':
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT))
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.session.close()
+
+    async def request(self, method: str, url: str, bucket: str='page',
+                      **kwargs) -> Tuple[int, bytes]:
+        # Returns the status code and body of the response.
+        limiter = wpa.buckets[bucket]
+        async with self.in_flight:
+            for attempt in range(wpa.THROTTLED_RETRIES + 1):
+                delay = limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                t = asyncio.get_event_loop().time()
+                try:
+                    async with self.session.request(method, url,
+                                                    **kwargs) as response:
+                        status = response.status
+                        body = await response.read()
+                        retry_after = response.headers.get('Retry-After')
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    status, body, retry_after = 599, b"", None
+                latency = asyncio.get_event_loop().time() - t
+                try:
+                    retry_after_s = float(retry_after or '')
+                except ValueError:
+                    retry_after_s = None
+                limiter.feedback(status, latency, retry_after_s)
+                profiling.record_request(method, url, bucket, status,
+                                         len(body), latency, delay)
+                if status not in (429, 503):
+                    break
+        return status, body
+
+    async def parse(self, func, *args):
+        if not self.pooled_parsing:
+            with profiling.phase(func.__name__):
+                return func(*args)
+        return await asyncio.get_event_loop().run_in_executor(
+            wpa.get_parser_pool(), func, *args)
+
+    async def get(self, url: str, bucket: str='page') -> Optional[bytes]:
+        status, body = await self.request('GET', url, bucket)
+        return body if status == 200 else None
+
+    async def get_npages(self, scope: WPScope,
+                         resolution: Resolution) -> int:
+        content = await self.get(wpa.get_scope_url(scope, resolution))
+        return parse_npages(content) if content is not None else 0
+
+    async def get_page_entries(self, scope: WPScope, resolution: Resolution,
+                               n: int) -> Optional[PageEntries]:
+        content = await self.get(wpa.get_scope_url(scope, resolution, n))
+        if content is None:
+            return None
+        return await self.parse(parse_page_entries, content)
+
+    async def get_wpid_scores(self, scope: WPScope,
+                              resolution: Resolution) -> PageEntries:
+        N = await self.get_npages(scope, resolution)
+        msg = "\rGathering wallpaper list for '{}': ".format(scope)
+
+        async def fetch(n: int) -> Tuple[int, PageEntries]:
+            return n, await self.get_page_entries(scope, resolution, n) or []
+
+        pages = []
+        for finished, f in enumerate(
+                asyncio.as_completed([fetch(n) for n in range(N)]), 1):
+            pages.append(await f)
+            print((msg + "{:.0f}%...").format(100.0*finished/N), end='')
+        print(msg + "done.")
+        return wpa.merge_pages(pages)
+
+    async def get_wpids(self, scope: WPScope, resolution: Resolution,
+                        min_score: Optional[float]=None) -> List[WPID]:
+        return [identifier for identifier, score
+                in await self.get_wpid_scores(scope, resolution)
+                if not min_score or (score >= min_score)]
+
+    async def get_wpdata(self, wpid: WPID) -> Optional[WPData]:
+        content = await self.get(wpa.get_wallpaper_page_url(wpid))
+        if content is None:
+            return None
+        return await self.parse(parse_wpdata, wpid, content)
+
+    async def get_wpdata_many(
+            self, wpids: Iterable[WPID]) -> Dict[WPID, Optional[WPData]]:
+        wpids = list(wpids)
+        results = await asyncio.gather(*(self.get_wpdata(w) for w in wpids))
+        return dict(zip(wpids, results))
+
+    async def get_image_url(self, id: WPID,
+                            resolution: Resolution) -> Optional[str]:
+        content = await self.get(wpa.get_download_page_url(id, resolution))
+        name = parse_image_name(content) if content is not None else None
+        return wpa.get_image_url_for_name(name) if name else None
+
+    async def vote(self, id: WPID, up: bool) -> None:
+        data = b"vote=yes" if up else b"vote=no"
+        # Errors here do not matter much.
+        await self.request('POST', wpa.get_vote_url(id), 'vote', data=data,
+                           headers=wpa.VOTE_HEADERS)
+
+
+def run(coro):
+    # asyncio.run() is not available on Python 3.6.
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+# Synchronous facade, for use from the CLI.
+
+def get_wpid_scores(scope: WPScope, resolution: Resolution) -> PageEntries:
+    async def main() -> PageEntries:
+        async with AsyncAccess(pooled_parsing=True) as access:
+            return await access.get_wpid_scores(scope, resolution)
+    return run(main())
+
+
+def get_wpdata_many(wpids: Iterable[WPID]) -> Dict[WPID, Optional[WPData]]:
+    async def main() -> Dict[WPID, Optional[WPData]]:
+        async with AsyncAccess(pooled_parsing=True) as access:
+            return await access.get_wpdata_many(wpids)
+    return run(main())
@@ -0,0 +1,122 @@
+import re
+from bs4 import BeautifulSoup, SoupStrainer
+from typing import List, Optional, Tuple
+
+from wpcraft.types import WPData, WPID
+
+# These functions turn raw HTML into compact results. They are kept apart
+# from fetching so that they can run in a process pool during crawls.
+
+# IDs and user scores of wallpapers, as listed on scope pages.
+PageEntries = List[Tuple[WPID, float]]
+
+# lxml is much faster than the pure Python parser, use it when available.
+try:
+    import lxml  # noqa: F401
+    PARSER = 'lxml'
+except ImportError:
+    PARSER = 'html.parser'
+
+# Only the parts of each page we actually read are parsed into a tree.
+LISTING_STRAINER = SoupStrainer('div', class_='wallpapers')
+PAGER_STRAINER = SoupStrainer('ul', class_='pager__list')
+DOWNLOAD_STRAINER = SoupStrainer('img', class_='wallpaper__image')
+WALLPAPER_STRAINER = SoupStrainer(['div', 'span', 'a'], class_=[
+    'wallpaper__tags', 'author__block', 'author__link',
+    re.compile('^wallpaper-votes__rate')])
+
+
+def make_soup(content: bytes, strainer: SoupStrainer) -> BeautifulSoup:
+    return BeautifulSoup(content, PARSER, parse_only=strainer)
+
+
+def parse_page_entries(content: bytes) -> Optional[PageEntries]:
+    soup = make_soup(content, LISTING_STRAINER)
+    wallpapers = soup.find_all('div', class_='wallpapers')
+    if len(wallpapers) == 0:  # graceful 404
+        return None
+    wallpapers = wallpapers[0].find_all('li', class_='wallpapers__item')
+
+    result = []
+    for w in wallpapers:
+        href = w.find_all('a')[0]['href']
+        identifier = href.split('/')[-2]
+        score_s = w.find_all('span', class_="wallpapers__info-rating")[0]
+        score_t = score_s.text.strip()
+        score = float(score_t or 0)
+        result.append((WPID(identifier), score))
+    return result
+
+
+def parse_wpdata(wpid: WPID, content: bytes) -> WPData:
+    soup = make_soup(content, WALLPAPER_STRAINER)
+    div_tags = soup.find_all('div', class_='wallpaper__tags')
+    tags: List[str]
+    if len(div_tags) == 0:
+        tags = []
+    else:
+        a_tags = div_tags[0].find_all('a')
+        tags = [a.get_text().replace('wallpapers', '').
+                replace('backgrounds', '').strip()
+                for a in a_tags]
+
+    author = license_ = source = None
+    div_authors = soup.find_all('div', class_='author__block')
+    if div_authors:
+        div_authors = div_authors[0]
+        arows = div_authors.find_all('div', class_="author__row")
+        for row in arows:
+            text = row.text.strip()
+            if text.startswith('Author: '):
+                author = text[8:].strip()
+            if text.startswith('License: '):
+                license_ = text[9:].strip()
+        sources = soup.find_all('a', class_="author__link")
+        if sources:
+            source = sources[0]['href']
+
+    if license_ and (license_.startswith("No licence") or
+                     license_.startswith("No license")):
+        license_ = None
+
+    score = 0.0
+    span_scores = soup.find_all('span', {
+        'class': lambda x: x and x.startswith('wallpaper-votes__rate')})
+    if span_scores:
+        if span_scores[0].text:
+            score = float(span_scores[0].text)
+
+    return WPData(wpid, tags, score, author, license_, source)
+
+
+def parse_npages(content: bytes) -> int:
+    soup = make_soup(content, PAGER_STRAINER)
+    pages_ul = soup.find_all('ul', class_='pager__list')
+    if len(pages_ul) == 0:
+        return 1
+
+    page_a = pages_ul[0].find_all('a', class_='pager__link')
+    if len(page_a) == 0:
+        return 1
+
+    lastpage_href = page_a[-1]['href']
+    if 'page=' in lastpage_href:
+        # Search results
+        get_args = (lastpage_href.split('/')[-1])[1:].split('&')
+        page_arg = [a[len('page='):]
+                    for a in get_args
+                    if a.startswith('page=')][0]
+        return int(page_arg)
+    else:
+        # Browsing catalog/tag
+        return int(lastpage_href.split('/')[-1][4:])
+
+
+def parse_image_name(content: bytes) -> Optional[str]:
+    # Returns the file name of the image offered on a download page.
+    soup = make_soup(content, DOWNLOAD_STRAINER)
+    imgs = soup.find_all('img', class_='wallpaper__image')
+    if len(imgs) == 0:
+        return None
+    src = imgs[0]['src']
+    return src.split('/')[-1]
@@ -1,41 +1,230 @@
+import os
+import sys
+import fcntl
 import time
 import requests
+import requests.adapters
 import threading
+import multiprocessing
 import collections
 import concurrent.futures
-from bs4 import BeautifulSoup
-from typing import List, Optional
+from contextlib import contextmanager
+from typing import (BinaryIO, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Set, Tuple)
+ProgressCallback = Callable[[int, Optional[int]], None]
 
 from wpcraft.types import WPScope, WPData, WPID, Resolution
-
-BASE_URL = "https://wallpaperscraft.com"
-REQ_PER_SECOND_LIMIT = 0.2
+from wpcraft.profiling import profiling
+from wpcraft.wpcraftaccess.parsing import (PageEntries, parse_page_entries,
+                                           parse_wpdata, parse_npages,
+                                           parse_image_name)
+
+# May point to a local stand-in server (see wpcraft.standin) instead.
+BASE_URL = os.getenv("WPCRAFT_BASE_URL") or "https://wallpaperscraft.com"
+
+
+# Default token bucket parameters for each kind of request: sustained rate
+# (requests per second), burst size, and the bounds within which the rate
+# adapts to server feedback.
+RATE_LIMITS: Dict[str, Dict[str, float]] = {
+    'page': {'rate': 5.0, 'burst': 5, 'min-rate': 0.5, 'max-rate': 10.0},
+    'image': {'rate': 2.0, 'burst': 2, 'min-rate': 0.2, 'max-rate': 4.0},
+    'vote': {'rate': 1.0, 'burst': 1, 'min-rate': 0.1, 'max-rate': 1.0},
+}
+# How many times a request is retried after the server asks us to slow down.
+THROTTLED_RETRIES = 3
+
+# Listing pages are fetched by up to this many threads at once, the
+# connection pool has to be large enough to let all of them reuse
+# connections.
+CRAWL_THREADS = 50
+
+# Pages are parsed in a pool of this many processes during crawls of at least
+# POOLED_PARSING_MIN_PAGES pages. For just a few pages, starting the workers
+# costs more than parsing in-process.
+PARSE_PROCESSES = os.cpu_count() or 1
+POOLED_PARSING_MIN_PAGES = 8
+
+# Incremental updates give up after this many listing pages without a single
+# wallpaper already in the index; a full crawl fetches pages concurrently.
+NEW_WPIDS_MAX_PAGES = 10
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Listing pages kept by a PageMemo, see shared_pages().
+PAGE_MEMO_SIZE = 64
+DOWNLOAD_TIMEOUT = 30
+DOWNLOAD_ATTEMPTS = 3
+# Signatures of image formats served by wallpaperscraft.com.
+IMAGE_MAGIC = [b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'RIFF', b'GIF8']
 
 s = requests.Session()
-
-
-class RateLimiter(collections.Iterator):
-    """Iterator that yields a value at most once every 'interval' seconds."""
-    def __init__(self, interval):
+s.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=CRAWL_THREADS))
+s.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=CRAWL_THREADS))
+
+
+class TokenBucket:
+    """Rate limiter allowing bursts of up to 'burst' requests, refilled at
+    'rate' requests per second.
+
+    The rate adapts to server feedback: it is cut down multiplicatively when
+    the server returns 429/5xx or latency rises well above its usual level,
+    and ramps up additively while responses are healthy.
+    """
+    BACKOFF_FACTOR = 0.5
+    SLOWDOWN_FACTOR = 0.9
+    RAMP_UP_STEP = 0.1
+    SLOW_LATENCY_RATIO = 2.0
+    LATENCY_SMOOTHING = 0.1
+
+    def __init__(self, rate: float, burst: float,
+                 min_rate: Optional[float]=None,
+                 max_rate: Optional[float]=None) -> None:
         self.lock = threading.Lock()
-        self.interval = interval
-        self.next_yield = 0
-
-    def __next__(self):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate or rate
+        self.max_rate = max_rate or rate
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.latency: Optional[float] = None
+
+    def _refill(self, t: float) -> None:
+        self.tokens = min(self.burst,
+                          self.tokens + (t - self.last_refill) * self.rate)
+        self.last_refill = t
+
+    def reserve(self, amount: float=1) -> float:
+        # Takes tokens and returns how many seconds the caller has to wait
+        # before using them. Tokens may go negative, which queues callers up
+        # without holding the lock while they sleep.
         with self.lock:
             t = time.monotonic()
-            if t < self.next_yield:
-                time.sleep(self.next_yield - t)
-                t = time.monotonic()
-            self.next_yield = t + self.interval
+            self._refill(t)
+            self.tokens -= amount
+            delay = max(0.0, -self.tokens / self.rate)
+            return max(delay, self.paused_until - t)
+
+    def acquire(self, amount: float=1) -> float:
+        delay = self.reserve(amount)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def feedback(self, status: int, latency: float,
+                 retry_after: Optional[float]=None) -> None:
+        with self.lock:
+            t = time.monotonic()
+            self._refill(t)
+            if status == 429 or status >= 500:
+                self.rate = max(self.min_rate,
+                                self.rate * self.BACKOFF_FACTOR)
+                self.tokens = min(self.tokens, 0.0)
+                if retry_after:
+                    self.paused_until = max(self.paused_until,
+                                            t + retry_after)
+                return
+            if self.latency is None:
+                self.latency = latency
+            slow = latency > self.latency * self.SLOW_LATENCY_RATIO
+            self.latency += self.LATENCY_SMOOTHING * (latency - self.latency)
+            if slow:
+                self.rate = max(self.min_rate,
+                                self.rate * self.SLOWDOWN_FACTOR)
+            else:
+                self.rate = min(self.max_rate,
+                                self.rate + self.RAMP_UP_STEP)
+
+
+buckets: Dict[str, TokenBucket] = {}
+
+
+def set_base_url(url: str) -> None:
+    global BASE_URL
+    BASE_URL = url.rstrip('/')
+
+
+def configure_rate_limits(
+        overrides: Optional[Dict[str, Dict[str, float]]]=None) -> None:
+    overrides = overrides or {}
+    for name, defaults in RATE_LIMITS.items():
+        params = dict(defaults, **overrides.get(name, {}))
+        if params['min-rate'] > params['max-rate']:
+            exit("Error: rate-limits.{}: min-rate is higher than "
+                 "max-rate.".format(name))
+        # The adaptive limiter never leaves [min-rate, max-rate], so it must
+        # not start outside of it either.
+        rate = min(max(params['rate'], params['min-rate']),
+                   params['max-rate'])
+        buckets[name] = TokenBucket(rate, params['burst'],
+                                    params['min-rate'], params['max-rate'])
+
+
+configure_rate_limits()
+
+
+parser_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+# Crawl threads may ask for the pool at the same time.
+parser_pool_lock = threading.Lock()
+
+
+def get_parser_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global parser_pool
+    with parser_pool_lock:
+        if parser_pool is None:
+            kwargs = {}
+            if sys.version_info >= (3, 7):
+                # Workers must not be forked from a process running crawl
+                # threads.
+                kwargs['mp_context'] = multiprocessing.get_context(
+                    'forkserver')
+            parser_pool = concurrent.futures.ProcessPoolExecutor(
+                PARSE_PROCESSES, **kwargs)
+        return parser_pool
+
+
+def use_pooled_parsing(npages: int) -> bool:
+    return PARSE_PROCESSES > 1 and npages >= POOLED_PARSING_MIN_PAGES
+
+
+def parse_retry_after(response: requests.Response) -> Optional[float]:
+    try:
+        return float(response.headers.get('Retry-After', ''))
+    except ValueError:
+        return None
+
 
+def throttled_request(method: str, url: str, bucket: str='page',
+                      **kwargs) -> requests.Response:
+    limiter = buckets[bucket]
+    for attempt in range(THROTTLED_RETRIES + 1):
+        wait = limiter.acquire()
+        t = time.monotonic()
+        response = s.request(method, url, **kwargs)
+        latency = time.monotonic() - t
+        limiter.feedback(response.status_code, latency,
+                         parse_retry_after(response))
+        # Streamed bodies have not been read yet.
+        nbytes = (int(response.headers.get('Content-Length', 0) or 0)
+                  if kwargs.get('stream') else len(response.content))
+        profiling.record_request(method, url, bucket, response.status_code,
+                                 nbytes, latency, wait)
+        if (response.status_code not in (429, 503) or
+                attempt == THROTTLED_RETRIES):
+            break
+        response.close()
+    return response
 
-wallpaperscraft_rate_limit = RateLimiter(REQ_PER_SECOND_LIMIT)
 
+def throttled_get(url: str, bucket: str='page',
+                  **kwargs) -> requests.Response:
+    return throttled_request('GET', url, bucket, **kwargs)
 
-def throttled_get(*args):
-    next(wallpaperscraft_rate_limit)
-    return s.get(*args)
+
+def throttled_post(url: str, bucket: str='vote',
+                   **kwargs) -> requests.Response:
+    return throttled_request('POST', url, bucket, **kwargs)
 
 
 def get_scope_url(scope: WPScope,
@@ -57,159 +246,341 @@ def get_scope_url(scope: WPScope,
     exit("Error: Invalid wallpaper scope '{}'".format(scope))
 
 
+class PageMemo:
+    """Listing pages fetched recently, shared by everything crawling at the
+    same time.
+
+    The first page of a listing is fetched both for the page count and for
+    its entries, and scopes updated together may list the same pages.
+    Requests for a page already being fetched wait for that fetch instead
+    of making another one. Only the last 'size' pages are kept.
+    """
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.lock = threading.Lock()
+        self.pages: "collections.OrderedDict[str, concurrent.futures.Future]"
+        self.pages = collections.OrderedDict()
+
+    def get(self, url: str) -> Tuple[int, bytes]:
+        with self.lock:
+            future = self.pages.get(url)
+            owner = future is None
+            if owner:
+                future = self.pages[url] = concurrent.futures.Future()
+                while len(self.pages) > self.size:
+                    self.pages.popitem(last=False)
+        if not owner:
+            profiling.count("page-memo.hit")
+            return future.result()
+        profiling.count("page-memo.miss")
+        try:
+            page = throttled_get(url)
+            future.set_result((page.status_code, page.content))
+        except BaseException as e:
+            future.set_exception(e)
+            with self.lock:
+                if self.pages.get(url) is future:
+                    del self.pages[url]
+            raise
+        return future.result()
+
+
+page_memo: Optional[PageMemo] = None
+
+
+@contextmanager
+def shared_pages(size: int=PAGE_MEMO_SIZE) -> Iterator[PageMemo]:
+    # Within this block, listing pages are fetched through a PageMemo.
+    global page_memo
+    page_memo = PageMemo(size)
+    try:
+        yield page_memo
+    finally:
+        page_memo = None
+
+
+def get_listing_page(url: str) -> Tuple[int, bytes]:
+    # Returns the status code and content of a listing page.
+    if page_memo is not None:
+        return page_memo.get(url)
+    page = throttled_get(url)
+    return page.status_code, page.content
+
+
+def get_page_entries(scope: WPScope,
+                     resolution: Resolution,
+                     n: int,
+                     pooled: bool=False) -> Optional[PageEntries]:
+    # Returns IDs and user scores of wallpapers listed on the n-th page, or
+    # None if the page does not exist (e.g. past the last page). With
+    # pooled=True, the page is parsed in the parser process pool.
+    page_url = get_scope_url(scope, resolution, n)
+    status, content = get_listing_page(page_url)
+    if status != 200:
+        return None
+    with profiling.phase("parse_page_entries"):
+        if pooled:
+            return get_parser_pool().submit(
+                parse_page_entries, content).result()
+        return parse_page_entries(content)
+
+
+def iter_wpid_scores(
+        scope: WPScope,
+        resolution: Resolution,
+        npages: Optional[int]=None,
+        progress: Optional[ProgressCallback]=None
+) -> Iterator[Tuple[int, PageEntries]]:
+    # Fetches all listing pages of the scope concurrently and yields
+    # (page number, entries) pairs in the order in which the pages arrive.
+    # Progress is printed, or passed to progress as (pages done, total).
+    N = get_npages(scope, resolution) if npages is None else npages
+    if N == 0:
+        return
+
+    pooled = use_pooled_parsing(N)
+    if pooled:
+        get_parser_pool()
+
+    msg = "\rGathering wallpaper list for '{}': ".format(scope)
+    with concurrent.futures.ThreadPoolExecutor(CRAWL_THREADS) as executor:
+        futures = {executor.submit(get_page_entries, scope, resolution, n,
+                                   pooled): n
+                   for n in range(N)}
+        try:
+            finished = 0
+            for f in concurrent.futures.as_completed(futures):
+                finished += 1
+                if progress:
+                    progress(finished, N)
+                else:
+                    print((msg + "{:.0f}%...").format(100.0*finished/N),
+                          end='')
+                yield futures[f], f.result() or []
+        finally:
+            # Don't fetch the remaining pages if the caller stopped early.
+            for f in futures:
+                f.cancel()
+    if not progress:
+        print(msg + "done.")
+
+
+def merge_pages(pages: Iterable[Tuple[int, PageEntries]]) -> PageEntries:
+    # Removes duplicates, keeping the listing order.
+    result: Dict[WPID, float] = {}
+    for n, entries in sorted(pages, key=lambda p: p[0]):
+        for identifier, score in entries:
+            result.setdefault(identifier, score)
+    return list(result.items())
+
+
+def get_wpid_scores(scope: WPScope, resolution: Resolution,
+                    progress: Optional[ProgressCallback]=None) -> PageEntries:
+    return merge_pages(iter_wpid_scores(scope, resolution,
+                                        progress=progress))
+
+
 def get_wpids(scope: WPScope,
               resolution: Resolution,
               min_score: Optional[float]=None) -> List[WPID]:
-    N = get_npages(scope, resolution)
-
-    def gather_results_from_page_n(n: int) -> List[WPID]:
-        page_url = get_scope_url(scope, resolution, n)
-        page = throttled_get(page_url)
-        if page.status_code is not 200:
-            return []
-
-        soup = BeautifulSoup(page.content, 'html.parser')
-        wallpapers = soup.find_all('div', class_='wallpapers')
-        if len(wallpapers) == 0:  # graceful 404
-            return []
-        wallpapers = wallpapers[0].find_all('li', class_='wallpapers__item')
-
-        result = []
-        for w in wallpapers:
-            href = w.find_all('a')[0]['href']
-            identifier = href.split('/')[-2]
-            score_s = w.find_all('span', class_="wallpapers__info-rating")[0]
-            score_t = score_s.text.strip()
-            score = float(score_t or 0)
-            if not min_score or (score >= min_score):
-                result.append(identifier)
-        return result
-
-    with concurrent.futures.ThreadPoolExecutor(50) as executor:
-        futures = [executor.submit(gather_results_from_page_n, i)
-                   for i in range(N)]
-
-        # Wait for all requests to finish
-        finished = 0
-        score_msg = (" (min_score: {})".format(min_score)
-                     if min_score else "")
-        msg = "\rGathering wallpaper list for '{}'{}: ".format(
-            scope, score_msg)
-        while finished < N:
-            finished = sum(f.done() for f in futures)
-            print((msg + "{:.0f}%...").format(100.0*finished/N), end='')
-            time.sleep(0.1)
-        print(msg.format(100))
-
-    # Gather results
-    result = sum((f.result() for f in futures), [])
-
-    # Remove duplicates
-    result = list(set(result))
-
-    return result
+    return [identifier
+            for identifier, score in get_wpid_scores(scope, resolution)
+            if not min_score or (score >= min_score)]
+
+
+def get_new_wpid_scores(scope: WPScope,
+                        resolution: Resolution,
+                        known: Set[WPID],
+                        progress: Optional[ProgressCallback]=None
+                        ) -> Optional[PageEntries]:
+    # Listings are ordered from the newest wallpapers, so only the first few
+    # pages change between updates. Walk them in order and stop at the first
+    # page that brings nothing new. The number of pages to check is not
+    # known in advance, progress gets None for the total. Returns None if
+    # the index is empty or too stale for this to pay off, in which case the
+    # whole listing should be fetched instead.
+    if not known:
+        return None
+    result: Dict[WPID, float] = {}
+    n = 0
+    caught_up = False
+    while True:
+        if n == NEW_WPIDS_MAX_PAGES and not caught_up:
+            if not progress:
+                print()
+            return None
+        if progress:
+            progress(n, None)
+        else:
+            print("\rChecking '{}' for new wallpapers: page {}...".format(
+                scope, n + 1), end='')
+        entries = get_page_entries(scope, resolution, n)
+        if not entries:
+            break
+        new = [(identifier, score) for identifier, score in entries
+               if identifier not in known]
+        if not new:
+            break
+        caught_up = caught_up or len(new) < len(entries)
+        for identifier, score in new:
+            result.setdefault(identifier, score)
+        n += 1
+    if not progress:
+        print()
+    return list(result.items())
+
+
+def get_wallpaper_page_url(wpid: WPID) -> str:
+    return BASE_URL + "/wallpaper/{}".format(wpid)
 
 
 def get_wpdata(wpid: WPID) -> Optional[WPData]:
-    wallpaper_page_url = BASE_URL + "/wallpaper/{}".format(wpid)
-    page = throttled_get(wallpaper_page_url)
-    if page.status_code is not 200:
+    page = throttled_get(get_wallpaper_page_url(wpid))
+    if page.status_code != 200:
         return None
-
-    soup = BeautifulSoup(page.content, 'html.parser')
-    div_tags = soup.find_all('div', class_='wallpaper__tags')
-    tags: List[str]
-    if len(div_tags) == 0:
-        tags = []
-    else:
-        a_tags = div_tags[0].find_all('a')
-        tags = [a.get_text().replace('wallpapers', '').
-                replace('backgrounds', '').strip()
-                for a in a_tags]
-
-    author = license_ = source = None
-    div_authors = soup.find_all('div', class_='author__block')
-    if div_authors:
-        div_authors = div_authors[0]
-        arows = div_authors.find_all('div', class_="author__row")
-        for row in arows:
-            text = row.text.strip()
-            if text.startswith('Author: '):
-                author = text[8:].strip()
-            if text.startswith('License: '):
-                license_ = text[9:].strip()
-        sources = soup.find_all('a', class_="author__link")
-        if sources:
-            source = sources[0]['href']
-
-    if license_ and (license_.startswith("No licence") or
-                     license_.startswith("No license")):
-        license_ = None
-
-    score = 0.0
-    span_scores = soup.find_all('span', {
-        'class': lambda x: x and x.startswith('wallpaper-votes__rate')})
-    if span_scores:
-        if span_scores[0].text:
-            score = float(span_scores[0].text)
-
-    return WPData(wpid, tags, score, author, license_, source)
+    with profiling.phase("parse_wpdata"):
+        return parse_wpdata(wpid, page.content)
 
 
 def get_npages(scope: WPScope, resolution: Resolution) -> int:
     page_url = get_scope_url(scope, resolution)
-    page = throttled_get(page_url)
-    if page.status_code is not 200:
+    status, content = get_listing_page(page_url)
+    if status != 200:
         return 0
+    with profiling.phase("parse_npages"):
+        return parse_npages(content)
+
+
+def get_download_page_url(id: WPID, resolution: Resolution) -> str:
+    return BASE_URL + "/download/{}/{}x{}".format(
+        id, resolution.w, resolution.h)
 
-    soup = BeautifulSoup(page.content, 'html.parser')
-    pages_ul = soup.find_all('ul', class_='pager__list')
-    if len(pages_ul) == 0:
-        return 1
 
-    page_a = pages_ul[0].find_all('a', class_='pager__link')
-    if len(page_a) == 0:
-        return 1
+def get_image_url_for_name(name: str) -> str:
+    return BASE_URL + "/image/{}".format(name)
 
-    lastpage_href = page_a[-1]['href']
-    if 'page=' in lastpage_href:
-        # Search results
-        get_args = (lastpage_href.split('/')[-1])[1:].split('&')
-        page_arg = [a[len('page='):]
-                    for a in get_args
-                    if a.startswith('page=')][0]
-        return int(page_arg)
-    else:
-        # Browsing catalog/tag
-        return int(lastpage_href.split('/')[-1][4:])
+
+def resolve_image_url(id: WPID,
+                      resolution: Resolution) -> Tuple[bool, Optional[str]]:
+    # Returns whether the answer is known, and the URL if there is one. The
+    # wallpaper is known to be unavailable in the resolution only if its
+    # download page is missing or has no image on it; other errors say
+    # nothing about it and may go away when asked again.
+    page = throttled_get(get_download_page_url(id, resolution))
+    if page.status_code == 404:
+        return True, None
+    if page.status_code != 200:
+        return False, None
+    with profiling.phase("parse_image_name"):
+        name = parse_image_name(page.content)
+    return True, get_image_url_for_name(name) if name else None
 
 
 def get_image_url(id: WPID, resolution: Resolution) -> Optional[str]:
-    download_page_url = "https://wallpaperscraft.com/download/{}/{}x{}".format(
+    return resolve_image_url(id, resolution)[1]
+
+
+def is_image_file(path: str) -> bool:
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    return any(header.startswith(magic) for magic in IMAGE_MAGIC)
+
+
+def download_image(url: str, target: str,
+                   on_chunk: Optional[Callable[[int], None]]=None) -> bool:
+    # Downloads into a temporary file which is only renamed to the target
+    # once it is complete and looks like an image, so an interrupted
+    # download never leaves a truncated image behind. Partial downloads are
+    # resumed with a Range request. Returns false on failure. on_chunk is
+    # called with the size of every chunk received.
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    partial = target + '.part'
+    while True:
+        with open(partial, 'ab') as part:
+            # Another process (e.g. a prefetch running while `next` needs
+            # the same image) may be downloading into the same file. Wait
+            # for it to finish rather than appending to it at the same time.
+            fcntl.flock(part, fcntl.LOCK_EX)
+            try:
+                current = os.stat(partial).st_ino == os.fstat(
+                    part.fileno()).st_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                return download_into(url, target, part, on_chunk)
+        # The file was completed or discarded while we waited for it.
+        if os.path.exists(target):
+            return True
+
+
+def download_into(url: str, target: str, part: BinaryIO,
+                  on_chunk: Optional[Callable[[int], None]]) -> bool:
+    # Does the work of download_image, with the partial file open for
+    # appending and locked.
+    partial = part.name
+    for attempt in range(DOWNLOAD_ATTEMPTS):
+        offset = os.fstat(part.fileno()).st_size
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        try:
+            with throttled_get(url, bucket='image', stream=True,
+                               timeout=DOWNLOAD_TIMEOUT,
+                               headers=headers) as image:
+                if image.status_code == 206:
+                    total = image.headers.get('Content-Range', '')
+                    total = total.rsplit('/', 1)[-1]
+                elif image.status_code == 200:
+                    part.truncate(0)
+                    total = image.headers.get('Content-Length', '')
+                elif image.status_code == 416:
+                    # The partial file is no good, start over.
+                    part.truncate(0)
+                    continue
+                else:
+                    return False
+                for chunk in image.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    part.write(chunk)
+                    if on_chunk:
+                        on_chunk(len(chunk))
+        except requests.RequestException:
+            # Including connections dropped in the middle of the body; the
+            # next attempt resumes from what was received so far.
+            continue
+        finally:
+            part.flush()
+        if total.isdigit() and os.fstat(part.fileno()).st_size != int(total):
+            continue
+        if not is_image_file(partial):
+            os.remove(partial)
+            return False
+        os.replace(partial, target)
+        return True
+    return False
+
+
+def listed_image_url(id: WPID, resolution: Resolution) -> str:
+    # Images are named after the wallpaper and the resolution. For wallpapers
+    # found on a listing browsed in that resolution this saves a visit to the
+    # download page; if the guess turns out wrong, use get_image_url.
+    return BASE_URL + "/image/{}_{}x{}.jpg".format(
         id, resolution.w, resolution.h)
-    page = throttled_get(download_page_url)
-    if page.status_code is not 200:
-        return None
 
-    soup = BeautifulSoup(page.content, 'html.parser')
-    imgs = soup.find_all('img', class_='wallpaper__image')
-    if len(imgs) is 0:
-        return None
-    src = imgs[0]['src']
-    return "https://wallpaperscraft.com/image/{}".format(src.split('/')[-1])
 
+VOTE_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"
+}
 
-# If @up is true, you're voting UP. Otherwise you are voting DOWN.
-def vote(id: WPID, up: bool) -> None:
+
+def get_vote_url(id: WPID) -> str:
     id_n = id.split('_')[-1]
-    vote_url = "https://wallpaperscraft.com/ajax/votes/vote.json?image_id={}"
+    return BASE_URL + "/ajax/votes/vote.json?image_id={}".format(id_n)
 
+
+# If @up is true, you're voting UP. Otherwise you are voting DOWN.
+def vote(id: WPID, up: bool) -> None:
     data = b"vote=yes" if up else b"vote=no"
 
-    res = s.post(vote_url.format(id_n), data=data, headers={
-        "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8"
-    })
+    res = throttled_post(get_vote_url(id), data=data, headers=VOTE_HEADERS)
 
-    if res.status_code is not 200:
+    if res.status_code != 200:
         # print("Failed to share your vote with wallpaperscraft.com")
         pass  # Errors here do not matter much.